@@ -0,0 +1,92 @@
+# What the Logging feature records: the input as it came in, a chunk at a time, with
+# when each chunk got here, so it can be played back the way it happened with
+# sd --replay. When a capture gets to its size limit it's moved to .1 and a new one is
+# started, so there's never more than twice that on disk for a stream.
+#
+# The file starts with MAGIC and the wall clock time it was started (a double), then
+# it's records:
+#
+#   time (double) kind (byte) length (uint32) data
+#
+# time is seconds since the capture started, from the monotonic clock, and carries on
+# across a rotation. kind is DATA for input and IDLE for where the input went quiet
+# long enough for a prompt to be shown (that used to be a 🫣 in the file). Records are
+# buffered and written every Interval seconds or once there's Buffer bytes of them.
+import os
+import struct
+import time
+
+MAGIC = b'SDCAP1\n'
+HEADER = struct.Struct('<d')
+RECORD = struct.Struct('<dBI')
+DATA, IDLE = 0, 1
+MARKER = '🫣'.encode('utf-8')
+
+class Capture:
+    Interval = 1
+    Buffer = 2**16
+
+    def __init__(self, path, size = 16 * 2**20):
+        self.path = path
+        self.size = size
+        self.start = self.last = time.monotonic()
+        self.buffer = bytearray()
+        self.open()
+
+    def open(self):
+        self.file = open(self.path, 'wb')
+        self.file.write(MAGIC + HEADER.pack(time.time()))
+        self.written = len(MAGIC) + HEADER.size
+
+    def record(self, kind, data = b''):
+        now = time.monotonic()
+        self.buffer += RECORD.pack(now - self.start, kind, len(data))
+        self.buffer += data
+        if len(self.buffer) >= self.Buffer or now - self.last >= self.Interval:
+            self.flush()
+
+    def write(self, data):
+        self.record(DATA, data)
+
+    def idle(self):
+        self.record(IDLE)
+
+    def flush(self):
+        self.last = time.monotonic()
+        if not self.buffer:
+            return
+        if self.written + len(self.buffer) > self.size and self.written > len(MAGIC) + HEADER.size:
+            self.file.close()
+            os.replace(self.path, self.path + '.1')
+            self.open()
+        self.file.write(self.buffer)
+        self.file.flush()
+        self.written += len(self.buffer)
+        self.buffer.clear()
+
+    def close(self):
+        if not self.file.closed:
+            self.flush()
+            self.file.close()
+
+def read(path):
+    # (time, kind, data) for each record. Something that isn't a capture, like a log
+    # from before there were captures or one of the test files, is taken as its bytes
+    # split up on the 🫣s with no times.
+    with open(path, 'rb') as f:
+        data = f.read()
+
+    if not data.startswith(MAGIC):
+        for ix, piece in enumerate(data.split(MARKER)):
+            if ix:
+                yield 0, IDLE, b''
+            if piece:
+                yield 0, DATA, piece
+        return
+
+    offset = len(MAGIC) + HEADER.size
+    while offset + RECORD.size <= len(data):
+        when, kind, length = RECORD.unpack_from(data, offset)
+        offset += RECORD.size
+        yield when, kind, data[offset:offset + length]
+        offset += length
@@ -5,8 +5,6 @@
 #     "pylatexenc"
 # ]
 # ///
-from pylatexenc.latex2text import LatexNodes2Text
-
 class Parser:
   inState = False
   buffer = ''
@@ -27,5 +25,7 @@ def Plugin(text, state = None, style = None):
     Parser.inState = False
     Parser.buffer += text[:text.index('$$')]
 
+    # This is slow to import and most things don't have math in them
+    from pylatexenc.latex2text import LatexNodes2Text
     return [LatexNodes2Text().latex_to_text(Parser.buffer)]
 
@@ -0,0 +1,175 @@
+# The code that sd has shown, kept around so you can get back to it. There's two
+# files, in $TMP/sd/$UID by default:
+#
+#   savebrace      the blocks, each one followed by a NUL. This is what it's always
+#                  been so fzf and friends can still go through it.
+#   savebrace.idx  a line for every block, newest last, like this:
+#                  offset <tab> length <tab> language <tab> time <tab> hash
+#
+# Both are kept under a number of blocks and a number of bytes. When an append goes
+# over either, the oldest go until it's down to three quarters of both so this
+# doesn't happen on every append. A block that's already in there isn't written
+# again, its line in the index just moves to the end, and if it's already the last
+# one the index isn't touched at all. Everything happens under a lock so any number
+# of sd's can be at it at once. sd hands over its blocks in batches so that's once
+# for however many it's got.
+#
+#   python -m streamdown.savebrace list [-n 20] [-l python]
+#   python -m streamdown.savebrace get [N] [-l python]
+import os
+import time
+
+class Store:
+    def __init__(self, path, blocks = 500, size = 4 * 2**20):
+        self.path = path
+        self.index_path = path + '.idx'
+        self.lock_path = path + '.lock'
+        self.blocks = blocks
+        self.size = size
+
+    def lock(self, exclusive):
+        import fcntl
+        f = open(self.lock_path, 'a')
+        fcntl.flock(f, fcntl.LOCK_EX if exclusive else fcntl.LOCK_SH)
+        return f
+
+    def entries(self):
+        # [offset, length, language, time, hash], oldest first
+        if not os.path.exists(self.path):
+            return []
+        try:
+            with open(self.index_path, encoding='utf-8') as f:
+                entryList = []
+                for line in f:
+                    offset, length, language, when, digest = line.rstrip('\n').split('\t')
+                    entryList.append([int(offset), int(length), language, float(when), digest])
+                return entryList
+        except (FileNotFoundError, ValueError):
+            # there's no index, or it's garbage, so we make one
+            return self.legacy()
+
+    def legacy(self):
+        # From a savebrace file that doesn't have an index, like one from before there was one
+        import hashlib
+        try:
+            data = open(self.path, 'rb').read()
+            when = os.path.getmtime(self.path)
+        except FileNotFoundError:
+            return []
+        # Keyed on the hash so only the last of any repeats is kept
+        entryMap = {}
+        offset = 0
+        for block in data.split(b'\0')[:-1]:
+            digest = hashlib.sha1(block).hexdigest()[:16]
+            entryMap.pop(digest, None)
+            entryMap[digest] = [offset, len(block), '-', when, digest]
+            offset += len(block) + 1
+        return list(entryMap.values())
+
+    def write_index(self, entryList):
+        tmp_path = f"{self.index_path}.{os.getpid()}"
+        with open(tmp_path, 'w', encoding='utf-8') as f:
+            f.write(''.join(f"{offset}\t{length}\t{language}\t{when:.3f}\t{digest}\n" for offset, length, language, when, digest in entryList))
+        os.replace(tmp_path, self.index_path)
+
+    def append(self, blockList):
+        # blockList is [(text, language), ...], oldest first
+        import hashlib
+        with self.lock(True):
+            entryList = self.entries()
+            entryMap = {entry[4]: entry for entry in entryList}
+            changed = False
+            with open(self.path, 'ab') as f:
+                for text, language in blockList:
+                    block = text.encode('utf-8')
+                    digest = hashlib.sha1(block).hexdigest()[:16]
+                    same = entryMap.get(digest)
+                    if same and same is entryList[-1] and language in (None, same[2]):
+                        # it's the last one already, a new time isn't worth a new index
+                        continue
+                    if same:
+                        entryList.remove(same)
+                        same[2], same[3] = language or same[2], time.time()
+                        entryList.append(same)
+                    else:
+                        offset = f.tell()
+                        f.write(block + b'\0')
+                        entryMap[digest] = [offset, len(block), language or '-', time.time(), digest]
+                        entryList.append(entryMap[digest])
+                    changed = True
+
+            if not changed:
+                return
+            if len(entryList) > self.blocks or sum(entry[1] + 1 for entry in entryList) > self.size:
+                entryList = self.compact(entryList)
+            self.write_index(entryList)
+
+    def compact(self, entryList):
+        # Keeps the newest that fit in three quarters of the limits and writes them
+        # out again, oldest first
+        keep = []
+        total = 0
+        for entry in reversed(entryList):
+            if len(keep) >= self.blocks * 3 // 4 or total + entry[1] + 1 > self.size * 3 // 4:
+                break
+            keep.append(entry)
+            total += entry[1] + 1
+        keep.reverse()
+
+        tmp_path = f"{self.path}.{os.getpid()}"
+        with open(self.path, 'rb') as old, open(tmp_path, 'wb') as new:
+            for entry in keep:
+                old.seek(entry[0])
+                block = old.read(entry[1])
+                entry[0] = new.tell()
+                new.write(block + b'\0')
+        os.replace(tmp_path, self.path)
+        return keep
+
+    def find(self, ix = 0, language = None):
+        # The ix'th newest block, of a language if there is one
+        with self.lock(False):
+            entryList = [entry for entry in reversed(self.entries()) if language in (None, entry[2])]
+            if ix >= len(entryList):
+                return None
+            entry = entryList[ix]
+            with open(self.path, 'rb') as f:
+                f.seek(entry[0])
+                return f.read(entry[1]).decode('utf-8', 'replace')
+
+def main():
+    import argparse
+    import tempfile
+
+    # Where sd's gettmpdir() puts it. sd itself is too much to import for this
+    parser = argparse.ArgumentParser(description="Look through the code blocks sd has saved (the Savebrace feature)")
+    parser.add_argument("--path", default=os.path.join(tempfile.gettempdir(), 'sd', str(os.getuid()), 'savebrace'), help="The savebrace file")
+    sub = parser.add_subparsers(dest='cmd', required=True)
+    p = sub.add_parser('list', help='newest first')
+    p.add_argument('-n', type=int, default=20, help='how many')
+    p.add_argument('-l', '--language')
+    p = sub.add_parser('get', help='print a block, the newest one unless you say otherwise')
+    p.add_argument('ix', type=int, nargs='?', default=0, help='0 is the newest, 1 the one before...')
+    p.add_argument('-l', '--language')
+    args = parser.parse_args()
+
+    store = Store(args.path)
+    if not os.path.exists(store.path):
+        parser.exit(1, f"{store.path} isn't there\n")
+    if args.cmd == 'get':
+        text = store.find(args.ix, args.language)
+        if text is None:
+            parser.exit(1)
+        print(text, end='' if text.endswith('\n') else '\n')
+        return
+
+    with store.lock(False):
+        entryList = [entry for entry in reversed(store.entries()) if args.language in (None, entry[2])][:args.n]
+        with open(store.path, 'rb') as f:
+            for ix, (offset, length, language, when, digest) in enumerate(entryList):
+                f.seek(offset)
+                first = f.read(min(length, 200)).decode('utf-8', 'replace').strip().split('\n')[0]
+                print(f"{ix:3d}  {time.strftime('%m-%d %H:%M', time.localtime(when))}  {language:10s} {length:7d}  {first[:60]}")
+
+if __name__ == "__main__":
+    main()
@@ -17,46 +17,67 @@ else
     exec python3 "$0" "$@"
 fi
 '''
-import appdirs, toml
+import appdirs
 import logging, tempfile
 import os,      sys
 import select
+import signal
+import threading
 
 if os.name != 'nt':
     import pty, termios, tty
 
+import codecs
+import collections
+import heapq
+import marshal
+import stat
 import math
 import re
 import shutil
 import traceback
-import colorsys
 import base64
 import subprocess
-from io import BytesIO
-from term_image.image import from_file, from_url
-import pygments.util
-from wcwidth import wcwidth
-from functools import reduce
+import time
+from io import BytesIO, StringIO
+from functools import lru_cache, reduce
 import textwrap
 import argparse
 from argparse import ArgumentParser
-from pygments import highlight
-from pygments.lexers import get_lexer_by_name
-from pygments.formatters import TerminalTrueColorFormatter
-from pygments.styles import get_style_by_name
+
+# pygments, term_image and asyncio take longer to import than everything else put
+# together, so they're imported where they're used. Plenty of answers don't have
+# any code or images in them and sd is run once per answer.
 
 if __package__ is None:
     from plugins import latex
+    import capture
+    from savebrace import Store
+    from width import ANSIESCAPE_RE, WIDTH, cjk_count, display_width, visible, visible_length
 else:
     from .plugins import latex
+    from . import capture
+    from .savebrace import Store
+    from .width import ANSIESCAPE_RE, WIDTH, cjk_count, display_width, visible, visible_length
 
 default_toml = """
 [features]
 CodeSpaces = false
 Clipboard  = true
 Logging    = false
+LoggingSize = 16
 Timeout    = 0.1
 Savebrace  = true
+SavebraceBlocks = 500
+SavebraceSize   = 4
+FrameInterval = 0.016
+FrameBytes    = 16384
+SyncUpdate    = true
+ImageTimeout  = 5.0
+ImageCache    = 64
+RenderCache   = 0
+TableRows     = 8
+TableWait     = 0.5
 
 [style]
 Margin          = 2 
@@ -75,6 +96,7 @@ Syntax  = "native"
 """
 
 def ensure_config_file(config):
+    import toml
     config_dir = appdirs.user_config_dir("streamdown")
     os.makedirs(config_dir, exist_ok=True)
     config_path = os.path.join(config_dir, "config.toml")
@@ -105,19 +127,40 @@ UNDERLINE = ["\033[4m", "\033[24m"]
 ITALIC    = ["\033[3m", "\033[23m"]
 STRIKEOUT = ["\033[9m", "\033[29m"]
 LINK      = ["\033]8;;", "\033]8;;\033\\"]
+SYNC      = ["\033[?2026h", "\033[?2026l"]
 SUPER     = [ 0x2070, 0x00B9, 0x00B2, 0x00B3, 0x2074, 0x2075, 0x2076, 0x2077, 0x2078, 0x2079 ]
 
+# How much we pull off the input in one go
+ReadSize = 2 ** 16
+
 ESCAPE = r"\033\[[0-9;]*[mK]"
-ANSIESCAPE = r'\033(?:\[[0-9;?]*[a-zA-Z]|][0-9]*;;.*?\\|\\)'
 KEYCODE_RE = re.compile(r'\x1B(?:[@-Z\\-_]|\[[0-?]*[ -/]*[@-~])')
 
-visible = lambda x: re.sub(ANSIESCAPE, "", x)
-# many characters have different widths
-visible_length = lambda x: sum(wcwidth(c) for c in visible(x))
 extract_ansi_codes = lambda text: re.findall(ESCAPE, text)
 remove_ansi = lambda line, codeList: reduce(lambda line, code: line.replace(code, ''), codeList, line)
 split_up = lambda line: re.findall(r'(\x1b[^m]*m|[^\x1b]*)', line)
 
+# Block level syntax. These are all tried in one go and the order matters,
+# for instance "- - -" is a list item and not a rule.
+BLOCK_RE = re.compile(
+    r'(?P<fence>^\s*(?:```|<pre>)\s*(?P<language>[^\s]+|$)\s*$)'
+    r'|(?P<table>^\s*\|(?:(?=(?P<separator>[\s|:-]+$)))?.+\|\s*$)'
+    r'|(?P<list>^(?P<indent>\s*)(?P<bullet>[\+*\-] |\+\-+|\d+\.\s+)(?P<content>.*))'
+    r'|(?P<header>^\s*(?P<level>#{1,6})\s*(?P<title>.*))'
+    r'|(?P<hr>^\s*(?P<rule>[-\*=_]){3,}\s*$)'
+)
+# Anything that doesn't start with one of these is just text
+BLOCK_LEAD = set('`<|+*-#=_0123456789')
+BLOCKQUOTE_RE = re.compile(r"^\s*((>\s*)+|<.?think>)")
+CODESPACES_RE = re.compile(r"^    \s*[^\s\*]")
+
+def classify(line):
+    # Returns the kind of block (a group name from BLOCK_RE) and the match, or (None, None) for text
+    if line.lstrip()[:1] not in BLOCK_LEAD:
+        return None, None
+    match = BLOCK_RE.match(line)
+    return (match.lastgroup, match) if match else (None, None)
+
 def gettmpdir():
     tmp_dir_all = os.path.join(tempfile.gettempdir(), "sd")
     os.makedirs(tmp_dir_all, mode=0o777, exist_ok=True)
@@ -130,19 +173,6 @@ def gettmpdir():
     os.makedirs(tmp_dir, exist_ok=True)
     return tmp_dir
 
-def debug_write(text):
-    if state.Logging:
-        if state.Logging == True:
-            state.Logging = tempfile.NamedTemporaryFile(dir=gettmpdir(), prefix="dbg", delete=False, mode="wb")
-        state.Logging.write(text)
-
-def savebrace():
-    if state.Savebrace and state.code_buffer_raw and os.name != 'nt':
-        path = os.path.join(gettmpdir(), 'savebrace')
-        with open(path, "a") as f:
-            f.write(state.code_buffer_raw + "\x00")
-            f.flush()
-
 class Goto(Exception):
     pass
 
@@ -156,9 +186,53 @@ class Code:
     Body = 'body'
     Flush = 'flush'
 
+class CodeBuffer:
+    # The raw text of the code we're in, for savebrace, scrape and the clipboard. Adding
+    # to one string copies the whole thing every time, so it's kept in pieces, and once
+    # there's more than Spill characters of it, it goes to a temporary file instead.
+    # That way a block of any length only takes so much memory.
+    Spill = 2**20
+
+    def __init__(self, text = ''):
+        self.pieceList = [text] if text else []
+        self.size = len(text)
+        self.file = None
+
+    def __iadd__(self, text):
+        if text:
+            self.size += len(text)
+            if self.file:
+                self.file.write(text)
+            else:
+                self.pieceList.append(text)
+                if self.size > self.Spill:
+                    self.file = tempfile.TemporaryFile('w+', encoding='utf-8', newline='')
+                    self.file.write(''.join(self.pieceList))
+                    self.pieceList = []
+        return self
+
+    def __len__(self):
+        return self.size
+
+    def spilled(self):
+        return self.file is not None
+
+    def chunks(self, size = 2**16):
+        if not self.file:
+            yield from self.pieceList
+            return
+        self.file.seek(0)
+        while chunk := self.file.read(size):
+            yield chunk
+        self.file.seek(0, os.SEEK_END)
+
+    def __str__(self):
+        return ''.join(self.chunks())
+
 class ParseState:
-    def __init__(self):
-        self.buffer = b''
+    def __init__(self, style):
+        self.style = style
+        self.buffer = ''
         self.current_line = ''
         self.first_line = True
         self.last_line_empty = False
@@ -167,7 +241,9 @@ class ParseState:
         self.maybe_prompt = False
         self.emit_flag = None
         self.scrape = None
-        self.scrape_ix = 0
+        # where the input is from and how far into it we are, for the scrape manifest
+        self.source = '-'
+        self.line_no = 0
         self.terminal = None
 
         self.WidthArg = None
@@ -183,10 +259,11 @@ class ParseState:
         # These are part of a trick to get
         # streaming code blocks while preserving
         # multiline parsing.
-        self.code_buffer = ""
-        self.code_buffer_raw = ""
+        self.code_buffer = ""   # the last Highlighter.Window or so of the block, wrapped
+        self.code_buffer_raw = CodeBuffer()
         self.code_gen = 0
         self.code_language = None
+        self.code_line_no = 0
         self.code_first_line = False
         self.code_indent = 0
         self.code_line = ''
@@ -201,6 +278,10 @@ class ParseState:
         self.in_bold = False
         self.in_italic = False
         self.in_table = False # (Code.[Header|Body] | False)
+        self.table_rows = []     # (cells, in_table, block_depth) held back to work out the column widths
+        self.table_natural = []  # [widest cell, longest word] of each column so far
+        self.table_basis = None  # what the column widths go by once they're decided
+        self.table_since = 0
         self.in_underline = False
         self.in_strikeout = False
         self.block_depth = 0
@@ -213,6 +294,29 @@ class ParseState:
         self.exit = 0
         self.where_from = None
 
+        # These carry over from one line to the next in parse_line
+        self.last_line_empty_cache = None
+        self.lexer = None
+        self.formatter = None
+        self.highlighter = None
+
+        # what width_calc last worked things out for
+        self.width_key = None
+
+        # emit holds a chunk back in case the next line turns it into a header
+        self.emit_buffer = []
+
+    # What carries over from one file to the next and changes how it comes out. With
+    # --jobs a file rendered on its own is only used where these were the same for it.
+    Carried = ['buffer', 'emit_flag', 'in_code', 'in_list', 'in_table', 'block_depth', 'bg', 'list_item_stack', 'ordered_list_numbers',
+               'list_indent_text', 'last_line_empty', 'last_line_empty_cache', 'first_indent', 'inline_code', 'in_bold', 'in_italic',
+               'in_underline', 'in_strikeout']
+
+    def carry(self):
+        carry = {name: getattr(self, name) for name in self.Carried}
+        carry['list_item_stack'], carry['ordered_list_numbers'] = list(self.list_item_stack), list(self.ordered_list_numbers)
+        return carry
+
     def current(self):
         state = { 'inline': self.inline_code, 'code': self.in_code, 'bold': self.in_bold, 'italic': self.in_italic, 'underline': self.in_underline, 'strikeout': self.in_strikeout }
         state['none'] = all(item is False for item in state.values())
@@ -222,130 +326,199 @@ class ParseState:
         self.inline_code = self.in_bold = self.in_italic = self.in_underline = self.in_strikeout = False
 
     def full_width(self, offset = 0):
-        return offset + (state.current_width(listwidth = True) if Style.PrettyBroken else self.WidthFull)
+        return offset + (self.current_width(listwidth = True) if self.style.PrettyBroken else self.WidthFull)
 
     def current_width(self, listwidth = False):
         # this will double count the left margin
-        return self.Width - (len(visible(self.space_left(listwidth)))) + Style.Margin
+        return self.Width - (len(visible(self.space_left(listwidth)))) + self.style.Margin
 
     def space_left(self, listwidth = False):
-        pre = ' ' * (len(state.list_item_stack)) * Style.ListIndent if listwidth else ''
-        return pre + Style.MarginSpaces + (Style.Blockquote * self.block_depth) if len(self.current_line) == 0 else "" 
+        pre = ' ' * (len(self.list_item_stack)) * self.style.ListIndent if listwidth else ''
+        return pre + self.style.MarginSpaces + (self.style.Blockquote * self.block_depth) if len(self.current_line) == 0 else "" 
 
-state = ParseState()
 
 def override_background(style_name, background_color):
+    # We make a new style off of the pygments one instead of
+    # reaching in and changing it for everyone
+    from pygments.styles import get_style_by_name
     base_style = get_style_by_name(style_name)
-    base_style.background_color = background_color
-    for i in base_style:
-        i[1]['bgcolor'] = background_color
-    for i,v in base_style.styles.items():
-        if v and 'bg' in v:
-            base_style.styles[i] = re.sub(r'bg:[^ ]*', '', base_style.styles[i] )
-    for k,v in base_style._styles.items():
-         if v[4] != '':
-             v[4] = ''
-
-    return base_style
-
-def format_table(rowList):
-    num_cols = len(rowList)
-    row_height = 0
-    wrapped_cellList = []
-
-    # Calculate max width per column (integer division)
-    # Subtract num_cols + 1 for the vertical borders '│'
-    available_width = state.current_width() - (num_cols * 2)
-
-    width_base = available_width // num_cols
-    width_mod  = available_width % num_cols
-
-    col_width_list = [width_base + (1 if i < width_mod else 0) for i in range(num_cols)]
-    bg_color = Style.Mid if state.in_table == Style.Head else Style.Dark
-    state.bg = f"{BG}{bg_color}"
-
-    # First Pass: Wrap text and calculate row heights
-    # Note this is where every cell is formatted so if 
-    # you are styling, do it before here!
-    for ix in range(len(rowList)):
-        row = rowList[ix]
-        wrapped_cell = text_wrap(row, width=col_width_list[ix], force_truncate=True, preserve_format=True)
-
-        # Ensure at least one line, even for empty cells
-        if not wrapped_cell:
-            wrapped_cell = [""]
-
-        wrapped_cellList.append(wrapped_cell)
-        row_height = max(row_height, len(wrapped_cell))
-
-    # --- Second Pass: Format and emit rows ---
-    for ix in range(row_height):
-        # This is the fancy row separator
-        extra = f"\033[4;58;2;{Style.Mid}" if not state.in_table == Style.Head and (ix == row_height - 1) else ""
-        line_segments = []
-
-        # Now we want to snatch this row index from all our cells
-        for iy in range(len(wrapped_cellList)):
-            cell = wrapped_cellList[iy]
-            segment = ''
-            if ix < len(cell):
-                segment = cell[ix]
-
-            # Margin logic is correctly indented here
-            margin_needed = col_width_list[iy] - visible_length(segment)
-            margin_segment = segment + (" " * max(0, margin_needed))
-            line_segments.append(f"{BG}{bg_color}{extra} {margin_segment}")
-
-        # Correct indentation: This should be outside the c_idx loop
-        joined_line = f"{BG}{bg_color}{extra}{FG}{Style.Symbol}│{RESET}".join(line_segments)
-        # Correct indentation and add missing characters
-        yield f"{state.space_left()}{FGRESET}{joined_line}{RESET}"
-
-    state.bg = BGRESET
-
-def emit_h(level, text):
-    text = line_format(text)
-    lineList = text_wrap(text)
-    res = []
-    for text in lineList:
-        spaces_to_center = (state.current_width() -  visible_length(text)) / 2
-        if level == 1:      #
-            res.append(f"{state.space_left()}\n{state.space_left()}{BOLD[0]}{' ' * math.floor(spaces_to_center)}{text}{BOLD[1]}\n")
-        elif level == 2:    ##
-            res.append(f"{state.space_left()}\n{state.space_left()}{BOLD[0]}{FG}{Style.Bright}{' ' * math.floor(spaces_to_center)}{text}{' ' * math.ceil(spaces_to_center)}{BOLD[1]}{FGRESET}")
-        elif level == 3:    ###
-            res.append(f"{state.space_left()}{FG}{Style.Head}{BOLD[0]}{text}{BOLD[1]}{FGRESET}")
-        elif level == 4:    ####
-            res.append(f"{state.space_left()}{FG}{Style.Symbol}{BOLD[0]}{text}{BOLD[1]}{FGRESET}")
-        elif level == 5:    #####
-            res.append(f"{state.space_left()}{text}{FGRESET}")
-        else: 
-            res.append(f"{state.space_left()}{FG}{Style.Grey}{text}{FGRESET}")
-    return "\n".join(res)
-
-def code_wrap(text_in):
-    if not Style.PrettyBroken and state.WidthWrap and len(text_in) > state.full_width():
-        return (0, [text_in])
-
-    # get the indentation of the first line
-    indent = len(text_in) - len(text_in.lstrip())
-    text = text_in.lstrip()
-    mywidth = state.full_width(-4 if Style.PrettyBroken else 0) - indent
-
-    # We take special care to preserve empty lines
-    if len(text) == 0:
-        return (0, [text_in])
-    res = [text[:mywidth]]
-
-    for i in range(mywidth, len(text), mywidth):
-        res.append(text[i : i + mywidth])
-
-    # sometimes just a newline wraps ... this isn't what we want actually
-    if res[-1].strip() == '':
-        res.pop()
-
-    return (indent, res)
+    return type(base_style.__name__, (base_style,), {
+        'background_color': background_color,
+        'styles': { k: re.sub(r'bg:[^ ]*', '', v) if v and 'bg' in v else v for k, v in base_style.styles.items() }
+    })
+
+# pygments loads its lexers, formatters and styles the first time they're asked for
+# and that isn't safe from more than one thread, so Renderers in threads take turns
+PygmentsLock = threading.Lock()
+
+@lru_cache(maxsize=32)
+def code_tools(language, syntax, background):
+    # LLMs tend to use a handful of languages over and over again so we hold on to
+    # the lexer, formatter and scrape extension. A language pygments doesn't know
+    # gets bash in the default style and that's remembered too.
+    with PygmentsLock:
+        from pygments.formatters import TerminalTrueColorFormatter
+        from pygments.lexers import get_lexer_by_name
+        from pygments.util import ClassNotFound
+        try:
+            lexer = get_lexer_by_name(language)
+            custom_style = override_background(syntax, background)
+        except ClassNotFound as e:
+            logging.debug(e)
+            lexer = get_lexer_by_name("Bash")
+            custom_style = override_background("default", background)
+            language = None
+
+        ext = None
+        if language and lexer.filenames:
+            ext = lexer.filenames[0].split('.')[-1]
+
+        return lexer, TerminalTrueColorFormatter(style=custom_style), ext
+
+class Highlighter:
+    # Relexing the whole code block for every new line is quadratic. Instead we lex from an
+    # anchor a ways back and everything before it is taken as done. A line start only becomes
+    # the anchor once lexing from there from scratch gives the same tokens as lexing from the
+    # anchor before it did, so we don't start in the middle of a string or a comment.
+    #
+    # Some things are one regex over many lines that only matches once its end shows up, like
+    # a bash heredoc or a C /* comment */, and then it colors everything back to where it
+    # started. To get those the anchor stays at least Lookback characters behind the new line.
+    Lookback = 2**9
+    # The most we'll lex for a line, after that the anchor moves up whether it agrees or not,
+    # to the start of a line even if that's partway through a token
+    Window = 2**12
+    # A line longer than this, like minified code, can have the anchor partway through it
+    # where a token starts, or it'd be relexed from its start for every wrapped piece
+    Long = 2**10
+
+    def __init__(self, lexer, formatter):
+        self.lexer = lexer
+        self.formatter = formatter
+        self.incremental = True
+
+        # The block from the anchor on, the way pygments would preprocess it, and what
+        # that lexed to as [(offset, token type, value)]
+        self.text = ''
+        self.anchor = 0
+        self.tokenList = []
+
+    def lex(self, text):
+        return list(self.lexer.get_tokens_unprocessed(text.rstrip('\n') + '\n'))
+
+    def advance(self, limit, force):
+        # The last place at or before limit a token starts that we could lex from
+        line_start = 0
+        offset = 0
+        for ix, _, value in self.tokenList:
+            if ix > limit:
+                break
+            if ix and (self.text[ix - 1] == '\n' or ix - line_start > self.Long):
+                offset = ix
+            if '\n' in value:
+                line_start = ix + value.rindex('\n') + 1
+        if not offset:
+            # Nothing starts a line, it's all one token, like a text block or a long
+            # docstring. Past Window we cut it at a line anyway, in the middle of it.
+            offset = self.text.rfind('\n', 0, limit) + 1 if force else 0
+            if not offset:
+                return
+
+        tail = [(ix - offset, ttype, value) for ix, ttype, value in self.tokenList if ix >= offset]
+        if force or self.lex(self.text[offset:]) == tail:
+            self.text = self.text[offset:]
+            self.anchor += offset
+
+    def highlight(self, tline):
+        import pygments
+        from pygments.token import Error
+        # carriage returns get rewritten by pygments and then our offsets are off
+        if '\r' in tline:
+            self.incremental = False
+        if not self.incremental:
+            return None
+
+        size = len(self.text)
+        if size > 2 * self.Lookback:
+            self.advance(size - self.Lookback, size > self.Window)
+
+        self.text = self.text + tline if self.text or self.anchor else tline.lstrip('\n')
+        self.tokenList = self.lex(self.text)
+
+        # Something longer than Lookback that started before the anchor can still turn up.
+        # If the new line comes out as garbage that's usually why, so we let the caller do it
+        # the slow way.
+        start = len(self.text) - len(tline)
+        if self.anchor and any(ttype is Error for ix, ttype, _ in self.tokenList if ix >= start):
+            return None
+
+        return pygments.format(((ttype, value) for _, ttype, value in self.tokenList), self.formatter)
+
+def code_snip(highlighted_code, tline, whole = True):
+    # wrap-around is a bunch of tricks. We essentially format longer and longer portions of code. The problem is
+    # the length can change based on look-ahead context so we need to use our expected place and
+    # then naively search back until our visible_lengths() match. This is not fast and there's certainly smarter
+    # ways of doing it but this thing is way trickery than you think
+    #
+    # If we were only handed the tail end of the highlighting (whole = False) and the search runs into
+    # the start of it then we can't be sure we'd land in the same place, so we return None.
+    parts = split_up(highlighted_code)
+
+    # Sometimes the highlighter will do things like a full reset or a background reset.
+    # This is mostly not what we want
+    parts = [ re.sub(r"\033\[[34]9(;00|)m", FORMATRESET, x) for x in parts]
+
+    # Since we are streaming we ignore the resets and newlines at the end
+    while parts[-1] in [FGRESET, FORMATRESET]:
+        parts.pop()
+
+    tline_len = visible_length(tline)
+
+    # now we find the new stuff:
+    ttl = 0
+    found = False
+    for i in range(len(parts)-1, 0, -1):
+        idx = parts[i]
+        if len(idx) == 0:
+            continue
+
+        ttl += len(idx) if idx[0] != '\x1b' else 0
+
+        if ttl > 1+tline_len:
+            found = True
+            break
+
+    if not whole and not found:
+        return None
+
+    newlen = visible_length("".join(parts[i:]))
+
+    snipfrom = newlen - len(tline) + 2
+    # this is all getting replaced with the new lexer so let's give a cheap
+    # fix for now:
+    if snipfrom == 1:
+        snipfrom = 0
+
+    if snipfrom > 0:
+        parts[i] = parts[i][snipfrom:]
+
+    this_batch = "".join(parts[i:])
 
+    if this_batch.startswith(FGRESET):
+        this_batch = this_batch[len(FGRESET) :]
+
+    # clean it before prepending with potential format 
+    this_batch = this_batch.strip()
+    while i - 1 >= 0 and parts[i-1] and parts[i-1][0] == '\x1b':
+         this_batch = parts[i-1] + this_batch
+         i -= 1
+
+    # The first part of a partial highlight may have been glued
+    # to what came before it in the whole thing
+    if not whole and i < 2:
+        return None
+
+    return this_batch
 
 # This marvelously obscure code "compacts" long lines of repetitive ANSI format strings by
 # removing duplicates. Here's how it works
@@ -384,244 +557,1215 @@ def ansi_collapse(codelist, inp):
     return codelist + inp
 
 
+SPLIT_RE = re.compile(
+    r'(?<=['
+        r'\u3000-\u303F'
+        r'\u4E00-\u9FFF'
+        r'\u3400-\u4DBF'
+        r'\uF900-\uFAFF'
+      r'])|(?=['
+        #r'\u4E00-\u9FFF'
+        r'\u3400-\u4DBF'
+        r'\uF900-\uFAFF'
+      r'])|\s+'
+)
+
 def split_text(text):
-    return [x for x in re.split(
-        r'(?<=['
-            r'\u3000-\u303F'
-            r'\u4E00-\u9FFF'
-            r'\u3400-\u4DBF'
-            r'\uF900-\uFAFF'
-          r'])|(?=['
-            #r'\u4E00-\u9FFF'
-            r'\u3400-\u4DBF'
-            r'\uF900-\uFAFF'
-          r'])|\s+',
-        text
-    ) if x]
-
-def text_wrap(text, width = -1, indent = 0, first_line_prefix="", subsequent_line_prefix="", force_truncate=False, preserve_format=False):
-    if width == -1:
-        width = state.Width
-
-    # The empty word clears the buffer at the end.
-    formatted = line_format(text)
-    words = split_text(formatted) + [""]
-
-    lines = []
-    current_line = ""
-    current_style = []
-    resetter = "" if preserve_format else FORMATRESET 
-    
-    oldword = ''
-    for word in words:
-        # we apply the style if we see it at the beginning of the word
-        codes = extract_ansi_codes(word)
-        if len(codes) and word.startswith(codes[0]):
-            # this pop(0) is intentional
-            current_style.append(codes.pop(0))
-
-        if len(word) and visible_length(current_line) + visible_length(word) + 1 <= width:  # +1 for space
-            space = ""
-            if len(visible(word)) > 0 and current_line:
-                space = " "
-            if (":" in visible(word) or cjk_count(word)) and cjk_count(oldword):
-                space = ""
-            current_line += space + word
+    # Without any CJK this is just splitting on whitespace
+    if text.isascii():
+        return text.split()
+    return [x for x in SPLIT_RE.split(text) if x]
+
+# A table cell without its markup, near enough to what it'll look like
+CELL_MARKUP_RE = re.compile(r"!?\[([^\]]*)\]\([^\)]*\)|\*\*|__|[*`~]")
+
+def cell_width(cell):
+    # How wide it is and how wide the longest word in it is
+    text = visible(CELL_MARKUP_RE.sub(lambda match: match.group(1) or '', cell))
+    return display_width(text), max(map(display_width, text.split()), default = 0)
+
+def truncate(line, width):
+    # This is what you'd get by lopping characters off the end and putting an ellipsis
+    # on until it fits, done in one pass. An escape that gets cut in half isn't an escape
+    # anymore so all of it counts.
+    escapes = {}
+    for match in ANSIESCAPE_RE.finditer(line):
+        escapes[match.start()] = match.end()
+
+    # widthList[ix] is the visible_length of line[:ix]
+    widthList = [0]
+    done = pending = 0
+    end = 0
+    for ix, c in enumerate(line):
+        end = escapes.get(ix, end)
+        if ix < end:
+            pending += WIDTH[c]
+            if ix + 1 == end:
+                pending = 0
         else:
-            # Word doesn't fit, finalize the previous line
-            prefix = first_line_prefix if not lines else subsequent_line_prefix
-            line_content = prefix + current_line  
-            # This is expensive, fix.
-            while force_truncate and visible_length(line_content) >= width:
-                line_content = line_content[:len(line_content) - 2] + "…"
+            done += WIDTH[c]
+        widthList.append(done + pending)
 
-            margin = max(0, width - visible_length(line_content))
+    for ix in range(len(line) - 2, 0, -1):
+        if widthList[ix] + 1 < width:
+            return line[:ix] + "…"
+    return "…"
 
-            if line_content.strip() != "":
-                # We make absolutely positively sure beyond any doubt
-                # that we have closed our hyperlink OSC
-                if LINK[0] in line_content:
-                    line_content += LINK[1]
-                lines.append(line_content + resetter + state.bg + ' ' * margin)
+def ansi2hex(ansi_code):
+    parts = ansi_code.strip('m').split(";")
+    r, g, b = map(int, parts)
+    return f"#{r:02x}{g:02x}{b:02x}"
 
-            current_line = (" " * indent) + "".join(current_style) + word
+def apply_multipliers(style, name, H, S, V):
+    import colorsys
+    m = style.get(name)
+    r, g, b = colorsys.hsv_to_rgb(min(1.0, H * m["H"]), min(1.0, S * m["S"]), min(1.0, V * m["V"]))
+    return ';'.join([str(int(x * 255)) for x in [r, g, b]]) + "m"
 
-        if len(codes):
-            current_style += codes
+# Images are fetched and drawn off to the side so a slow one doesn't hold up the
+# text. One pool for the process, made the first time there's an image.
+ImagePool = None
+ImagePoolLock = threading.Lock()
+
+def image_pool():
+    global ImagePool
+    with ImagePoolLock:
+        if ImagePool is None:
+            from concurrent.futures import ThreadPoolExecutor
+            ImagePool = ThreadPoolExecutor(max_workers = 4, thread_name_prefix = 'sd-image')
+    return ImagePool
+
+def load_image(url, height, timeout, cache_size = 0):
+    # This runs on the pool and hands back the image ready to write, or None if it
+    # couldn't be had. With a cache_size (in MB) what comes out is kept on disk too,
+    # so the next time it's neither fetched nor decoded. It's kept by the url or path,
+    # the file's mtime, the height, the terminal size and the kind of graphics the
+    # terminal does, since the output depends on all of those. A url is taken to not
+    # change, checking an ETag would mean going out to the network every time.
+    try:
+        from term_image.image import AutoImage, auto_image_class
+        from term_image.utils import get_terminal_size
+        from PIL import Image
+        remote = re.match(r"https?://", url.lower())
+        cache_path = None
+        if cache_size:
+            key = [url, height, tuple(get_terminal_size()), auto_image_class().__name__]
+            if not remote:
+                info = os.stat(url)
+                key += [info.st_mtime_ns, info.st_size]
+            cache_path = cache_file('images', key)
+            try:
+                with open(cache_path, encoding='utf-8') as f:
+                    res = f.read()
+                # this is how it knows what was used last
+                os.utime(cache_path)
+                return res
+            except OSError:
+                pass
 
-        if codes:
-            current_style = ansi_collapse(current_style, codes)
+        if remote:
+            import urllib.request
+            with urllib.request.urlopen(url, timeout = timeout) as response:
+                source = BytesIO(response.read())
+        else:
+            source = url
+        image = AutoImage(Image.open(source))
+        image.height = height
+        res = f"{image:|.-1#}\n"
+        if cache_path:
+            cache_put(cache_path, res, cache_size * 2**20)
+        return res
+    except Exception:
+        return None
+
+def cache_file(kind, key):
+    # images/ and renders/ in the user cache dir, each with its own cap
+    import hashlib
+    name = hashlib.sha1(repr(key).encode('utf-8')).hexdigest()
+    return os.path.join(appdirs.user_cache_dir("streamdown"), kind, name)
+
+def cache_put(cache_path, text, cap):
+    # If the directory's over cap bytes after this, the least recently used ones go
+    try:
+        cache_dir = os.path.dirname(cache_path)
+        os.makedirs(cache_dir, exist_ok=True)
+        tmp_path = f"{cache_path}.{os.getpid()}.{threading.get_ident()}"
+        with open(tmp_path, 'w', encoding='utf-8') as f:
+            f.write(text)
+        os.replace(tmp_path, cache_path)
+
+        entryList = []
+        for entry in os.scandir(cache_dir):
+            info = entry.stat()
+            entryList.append((info.st_mtime, info.st_size, entry.path))
+        total = sum(size for _, size, _ in entryList)
+        for _, size, path in sorted(entryList):
+            if total <= cap:
+                break
+            os.remove(path)
+            total -= size
+    except OSError:
+        # another sd got to it first, or we can't write there. Either way it's only a
+        # cache. This can be on the image pool so there's no logging, that goes to the
+        # output.
+        pass
+
+class ScrapeList:
+    # --jobs. Stands in for the Scraper in a worker process and keeps the blocks so
+    # render_paths can hand them to the real one, in order, if it uses that render
+    def __init__(self):
+        self.blockList = []
+
+    def add(self, text, language, ext, source, line):
+        self.blockList.append((str(text), language, ext, source, line))
+
+class Scraper:
+    # -s/--scrape. The stream hands the blocks over to a thread that does the writing so
+    # it never waits on the disk. A block whose hash is already in the directory isn't
+    # written again. Every block, repeats included, gets a line in manifest.jsonl:
+    #
+    #   {"index": 3, "file": "file_3.py", "language": "python", "hash": sha256,
+    #    "size": bytes, "source": "notes.md", "line": 12, "duplicate": false}
+    #
+    # where source is the file (- for stdin) and line is where the fence was in it. The
+    # manifest is locked while it's read and added to so any number of sd's can scrape
+    # to the same directory, and the numbering carries on from what's already there.
+    Manifest = 'manifest.jsonl'
+
+    def __init__(self, path):
+        import queue
+        self.path = path
+        self.queue = queue.SimpleQueue()
+        self.thread = None
+        self.failed = 0
+        # hash: [index, file] of what's in the directory so far
+        self.seen = {}
+        self.ix = 0
+        self.offset = 0
+
+    def add(self, text, language, ext, source, line):
+        if self.thread is None:
+            self.thread = threading.Thread(target = self.run, name = 'sd-scrape', daemon = True)
+            self.thread.start()
+        self.queue.put((text, language, ext, source, line))
+
+    def close(self):
+        # Waits for what's still to be written. Hands back how many couldn't be.
+        if self.thread:
+            self.queue.put(None)
+            self.thread.join()
+            self.thread = None
+        return self.failed
+
+    def run(self):
+        try:
+            os.makedirs(self.path, exist_ok = True)
+            # so files from before there was a manifest don't get written over
+            for name in os.listdir(self.path):
+                match = re.match(r'file_(\d+)\.', name)
+                if match:
+                    self.ix = max(self.ix, int(match.group(1)) + 1)
+        except OSError:
+            pass
+        while (item := self.queue.get()) is not None:
+            try:
+                self.write(*item)
+            except OSError:
+                # like the image pool, no logging from here
+                self.failed += 1
+
+    def write(self, text, language, ext, source, line):
+        # text is the block's CodeBuffer, which could have gone to disk
+        import hashlib, json
+        digest = hashlib.sha256()
+        size = 0
+        for chunk in text.chunks():
+            data = chunk.encode('utf-8')
+            digest.update(data)
+            size += len(data)
+        digest = digest.hexdigest()
+        with open(os.path.join(self.path, self.Manifest), 'a+', encoding = 'utf-8') as f:
+            if os.name != 'nt':
+                import fcntl
+                fcntl.flock(f, fcntl.LOCK_EX)
+            # anything other sd's have put in since we last looked
+            f.seek(self.offset)
+            for entry in f.read().splitlines():
+                try:
+                    entry = json.loads(entry)
+                    self.seen.setdefault(entry['hash'], [entry['index'], entry['file']])
+                    self.ix = max(self.ix, entry['index'] + 1)
+                except (ValueError, KeyError, TypeError):
+                    pass
+
+            duplicate = digest in self.seen
+            if not duplicate:
+                self.seen[digest] = [self.ix, f"file_{self.ix}.{ext}"]
+                self.ix += 1
+                with open(os.path.join(self.path, self.seen[digest][1]), 'w', encoding = 'utf-8', newline = '') as code:
+                    for chunk in text.chunks():
+                        code.write(chunk)
+
+            index, name = self.seen[digest]
+            f.write(json.dumps({'index': index, 'file': name, 'language': language, 'hash': digest, 'size': size, 'source': source, 'line': line, 'duplicate': duplicate}) + '\n')
+            f.flush()
+            self.offset = f.tell()
+
+FEATURES = ['CodeSpaces', 'Clipboard', 'Logging', 'LoggingSize', 'Timeout', 'Savebrace', 'SavebraceBlocks', 'SavebraceSize', 'FrameInterval', 'FrameBytes', 'SyncUpdate', 'ImageTimeout', 'ImageCache', 'RenderCache', 'TableRows', 'TableWait']
+
+def resolve_settings(config, base):
+    # Works out everything a Renderer needs from the config files and --base. This
+    # is the slow way, see settings()
+    import toml
+    config = ensure_config_file(config)
+    defaults = toml.loads(default_toml)
+    style_config = defaults.get('style') | config.get("style", {})
+    features = defaults.get('features') | config.get("features", {})
+    H, S, V = style_config.get("HSV")
+
+    if base:
+        env_colors = base.split(",")
+        if len(env_colors) > 0: H = float(env_colors[0])
+        if len(env_colors) > 1: S = float(env_colors[1])
+        if len(env_colors) > 2: V = float(env_colors[2])
+
+    style = {}
+    for color in ["Dark", "Mid", "Symbol", "Head", "Grey", "Bright"]:
+        style[color] = apply_multipliers(style_config, color, H, S, V)
+    for attr in ['PrettyPad', 'PrettyBroken', 'Margin', 'ListIndent', 'Syntax', 'Width']:
+        style[attr] = style_config.get(attr)
+
+    style['MarginSpaces'] = " " * style['Margin']
+    style['Blockquote'] = f"{FG}{style['Grey']}│ "
+    style['Codebg'] = f"{BG}{style['Dark']}"
+    style['Link'] = f"{FG}{style['Symbol']}{UNDERLINE[0]}"
+    style['DarkHex'] = ansi2hex(style['Dark'])
+
+    return {'style': style, 'features': {attr: features.get(attr) for attr in FEATURES}}
+
+# What resolve_settings came up with, by key, for this process
+Settings = {}
+
+def sd_version():
+    # What the output of a render depends on besides the input and the settings: our
+    # own files and pygments. Their mtimes will do, it's quicker than asking for versions.
+    import importlib.util
+    here = os.path.dirname(os.path.abspath(__file__))
+    pathList = [os.path.join(here, name) for name in sorted(os.listdir(here)) if name.endswith('.py')]
+    spec = importlib.util.find_spec('pygments')
+    if spec and spec.origin:
+        pathList.append(spec.origin)
+    return [os.stat(path).st_mtime_ns for path in pathList]
+
+def settings(config = None, base = None):
+    # sd gets run a lot for short answers so we don't want to be parsing toml and doing
+    # color math every time. The result is kept in the user cache dir under a key made of
+    # everything that goes into it: the config file and its mtime, the -c override (and its
+    # mtime if it's a file), --base and this file's mtime for when sd itself changes. If a
+    # -c file isn't a regular file, like <(echo ...), we can't tell if it changed so we
+    # don't cache.
+    config_path = os.path.join(appdirs.user_config_dir("streamdown"), "config.toml")
+    try:
+        key = [sys.version, os.stat(__file__).st_mtime_ns, config_path, config, base]
+        for path in [config_path, config]:
+            if path and os.path.exists(path):
+                info = os.stat(path)
+                if not stat.S_ISREG(info.st_mode):
+                    return resolve_settings(config, base)
+                key += [info.st_mtime_ns, info.st_size]
+            elif path == config_path:
+                # ensure_config_file will be making it
+                return resolve_settings(config, base)
+    except OSError:
+        return resolve_settings(config, base)
+
+    key = repr(key)
+    if key in Settings:
+        return Settings[key]
+
+    cache_path = os.path.join(appdirs.user_cache_dir("streamdown"), "settings.cache")
+    cache = {}
+    try:
+        with open(cache_path, 'rb') as f:
+            cache = marshal.load(f)
+    except Exception:
+        # missing, from another python or just garbage
+        pass
+
+    if not isinstance(cache, dict) or key not in cache:
+        cache = cache if isinstance(cache, dict) else {}
+        cache[key] = resolve_settings(config, base)
+
+        # We keep a few around for people who switch between --base values
+        while len(cache) > 16:
+            del cache[next(iter(cache))]
+        try:
+            os.makedirs(os.path.dirname(cache_path), exist_ok=True)
+            tmp_path = f"{cache_path}.{os.getpid()}.{threading.get_ident()}"
+            with open(tmp_path, 'wb') as f:
+                marshal.dump(cache, f)
+            os.replace(tmp_path, cache_path)
+        except OSError as ex:
+            logging.debug(f"Can't write settings cache: {ex}")
+
+    Settings[key] = cache[key]
+    return Settings[key]
+
+# Asking the terminal how wide it is every line isn't free, so the cli remembers it and
+# lets SIGWINCH tell it when it changes. A Renderer in someone else's program doesn't get
+# to take the signal, so there, or if somebody else already has it, we always ask.
+TerminalWidth = None
+WatchingResize = False
+
+def on_resize(signum, frame):
+    global TerminalWidth
+    TerminalWidth = None
+
+def watch_resize():
+    # only main() calls this, from the main thread
+    global WatchingResize
+    if hasattr(signal, 'SIGWINCH') and signal.getsignal(signal.SIGWINCH) in (signal.SIG_DFL, None):
+        signal.signal(signal.SIGWINCH, on_resize)
+        WatchingResize = True
+
+def terminal_width():
+    global TerminalWidth
+    if TerminalWidth is None or not WatchingResize:
+        TerminalWidth = shutil.get_terminal_size().columns
+    return TerminalWidth
+
+class FrameWriter:
+    # Writing and flushing every chunk means a syscall and a repaint for every line, which
+    # flickers over ssh and in tmux. This holds on to the output and writes it out in frames:
+    # when it's been interval seconds since the last one, when there's size characters of it,
+    # or when flush() is called, which the renderer does before it waits on input. An interval
+    # of 0 writes everything straight away.
+    #
+    # With sync each frame is a synchronized update (DEC mode 2026) so the terminal paints it
+    # in one go. Terminals that don't know about it just ignore it.
+    def __init__(self, out, interval = 0.016, size = 2 ** 14, sync = None):
+        self.out = out
+        self.interval = interval
+        self.size = size
+        if sync is None:
+            sync = hasattr(out, 'isatty') and out.isatty()
+        self.sync = sync
+        self.bufferList = []
+        self.pending = 0
+        self.last = time.monotonic()
+        self.stats = None
+
+    def write(self, text):
+        self.bufferList.append(text)
+        self.pending += len(text)
+        if self.pending >= self.size or time.monotonic() - self.last >= self.interval:
+            self.flush()
+
+    def flush(self):
+        self.last = time.monotonic()
+        if not self.pending:
+            return
+        text = "".join(self.bufferList)
+        self.bufferList = []
+        self.pending = 0
+        if self.sync:
+            text = f"{SYNC[0]}{text}{SYNC[1]}"
+        self.out.write(text)
+        self.out.flush()
+        if self.stats:
+            self.stats.flushed(text)
+
+class Stats:
+    # What --stats reports. Most of all it's how long it takes from a chunk of input
+    # being read to the output for it being written. A chunk counts as written when
+    # every line it's part of has been rendered, isn't being held back by emit, and
+    # the writer has flushed. Offsets here are in characters of input.
+    Buckets = [1, 2, 5, 10, 20, 50, 100, 200, 500, 1000]
+
+    def __init__(self):
+        self.start = time.perf_counter()
+        self.pending = collections.deque() # (read time, offset at the end of the chunk)
+        self.read = 0
+        self.consumed = 0
+        self.covered = 0
+        self.latencyList = []
+        self.bytes_in = self.bytes_out = 0
+        self.flushes = 0
+        self.select_wait = 0
+        self.lines = {}
+
+    def arrived(self, size, length):
+        self.bytes_in += size
+        self.read += length
+        self.pending.append((time.perf_counter(), self.read))
+
+    def rendered(self, length, held):
+        # If emit is holding output back it's from this line, so everything before
+        # this line is out
+        self.covered = self.consumed if held else self.consumed + length
+        self.consumed += length
+
+    def flushed(self, text):
+        now = time.perf_counter()
+        self.flushes += 1
+        self.bytes_out += len(text.encode('utf-8', 'replace'))
+        while self.pending and self.pending[0][1] <= self.covered:
+            self.latencyList.append(now - self.pending.popleft()[0])
+
+    def block(self, kind):
+        self.lines[kind] = self.lines.get(kind, 0) + 1
+
+    def summary(self):
+        latencyList = sorted(self.latencyList)
+        pct = lambda p: 1000 * latencyList[min(len(latencyList) - 1, int(len(latencyList) * p))] if latencyList else 0
+        histogram = {}
+        for bound in self.Buckets + [None]:
+            histogram[f"<{bound}ms" if bound else f">={self.Buckets[-1]}ms"] = 0
+        for latency in latencyList:
+            bound = next((b for b in self.Buckets if 1000 * latency < b), None)
+            histogram[f"<{bound}ms" if bound else f">={self.Buckets[-1]}ms"] += 1
+
+        return {
+            'seconds': time.perf_counter() - self.start,
+            'bytes_in': self.bytes_in, 'bytes_out': self.bytes_out, 'flushes': self.flushes,
+            'chunks': len(latencyList),
+            'latency_ms': { 'p50': pct(0.50), 'p95': pct(0.95), 'p99': pct(0.99), 'max': pct(1) },
+            'histogram': histogram,
+            'select_wait': self.select_wait,
+            'lines': self.lines,
+        }
+
+    def report(self, where):
+        res = self.summary()
+        if where != '-':
+            import json
+            with open(where, 'w') as f:
+                json.dump(res, f, indent=2)
+            return
+
+        most = max(res['histogram'].values()) or 1
+        out = [
+            f"{res['bytes_in']} bytes in, {res['bytes_out']} bytes out, {res['flushes']} writes in {res['seconds']:.2f}s",
+            f"waiting on input {res['select_wait']:.2f}s",
+            "latency " + "  ".join(f"{k} {v:.1f}ms" for k, v in res['latency_ms'].items()) + f"  ({res['chunks']} chunks)",
+        ]
+        for bucket, count in res['histogram'].items():
+            out.append(f"  {bucket:>8s} {'█' * math.ceil(40 * count / most):40s} {count}")
+        out.append("lines " + ", ".join(f"{k} {v}" for k, v in sorted(res['lines'].items(), key = lambda x: -x[1])))
+        print("\n".join(out), file=sys.stderr)
+
+class Profile:
+    # What --profile reports: where the time goes when rendering. The stages are the
+    # renderer's own methods, timed by putting a wrapper on the instance (see watch) so
+    # there's nothing in the way when it's off. They call each other, text_wrap calls
+    # line_format and so on, so each one keeps its total and its own time without the
+    # stages under it. "parse" is rendering a whole line, so its own time is everything
+    # that isn't one of the others. Getting the lexer for a code block, which is where
+    # pygments gets imported, counts as highlight but not as a call of it. Each is also split up by the kind of block the line
+    # was in, and the slowest lines are kept with their text.
+    Stages = ['line_format', 'code_highlight', 'code_lexer', 'code_wrap', 'text_wrap', 'format_table', 'emit_h']
+
+    def __init__(self, slowest = 10):
+        self.start = time.perf_counter()
+        self.kind = 'empty'
+        self.stack = []
+        self.times = {}         # (stage, kind): [calls, total, own]
+        self.count = 0
+        self.slowest = slowest
+        self.lineList = []      # heap of (seconds, line number, kind, text)
+
+    def watch(self, renderer):
+        import inspect
+        renderer.profile = self
+        for name in self.Stages:
+            fn = getattr(renderer, name)
+            if name == 'code_lexer':
+                setattr(renderer, name, self.timed(fn, 'highlight', calls = 0))
+                continue
+            stage = 'highlight' if name == 'code_highlight' else name
+            setattr(renderer, name, (self.timed_gen if inspect.isgeneratorfunction(fn) else self.timed)(fn, stage))
+        if renderer.out:
+            renderer.out.flush = self.timed(renderer.out.flush, 'write')
+
+        render = renderer.render
+        def timed_render(line):
+            self.kind = 'empty'
+            self.count += 1
+            start = self.enter()
+            try:
+                render(line)
+            finally:
+                took = self.leave('parse', start)
+                entry = (took, self.count, self.kind, line)
+                if len(self.lineList) < self.slowest:
+                    heapq.heappush(self.lineList, entry)
+                elif took > self.lineList[0][0]:
+                    heapq.heapreplace(self.lineList, entry)
+        renderer.render = timed_render
+        return self
+
+    def enter(self):
+        self.stack.append(0)
+        return time.perf_counter()
+
+    def leave(self, stage, start, calls = 1):
+        took = time.perf_counter() - start
+        inner = self.stack.pop()
+        if self.stack:
+            self.stack[-1] += took
+        entry = self.times.get((stage, self.kind))
+        if entry is None:
+            entry = self.times[(stage, self.kind)] = [0, 0, 0]
+        entry[0] += calls
+        entry[1] += took
+        entry[2] += took - inner
+        return took
+
+    def timed(self, fn, stage, calls = 1):
+        def wrapper(*args, **kwargs):
+            start = self.enter()
+            try:
+                return fn(*args, **kwargs)
+            finally:
+                self.leave(stage, start, calls)
+        return wrapper
+
+    def timed_gen(self, fn, stage):
+        # format_table yields its rows so only the time spent inside it counts
+        def wrapper(*args, **kwargs):
+            gen = fn(*args, **kwargs)
+            calls = 1
+            while True:
+                start = self.enter()
+                try:
+                    res = next(gen)
+                except StopIteration:
+                    return
+                finally:
+                    self.leave(stage, start, calls)
+                    calls = 0
+                yield res
+        return wrapper
+
+    def summary(self):
+        stages, blocks = {}, {}
+        for (stage, kind), (calls, total, own) in self.times.items():
+            entry = stages.setdefault(stage, {'calls': 0, 'total': 0, 'own': 0})
+            entry['calls'] += calls
+            entry['total'] += total
+            entry['own'] += own
+            block = blocks.setdefault(kind, {'lines': 0, 'own': {}})
+            block['own'][stage] = own
+            if stage == 'parse':
+                block['lines'] = calls
+                block['total'] = total
+
+        return {
+            'seconds': time.perf_counter() - self.start,
+            'lines': self.count,
+            'stages': stages,
+            'blocks': blocks,
+            'slowest': [
+                { 'seconds': took, 'line': number, 'kind': kind, 'text': text }
+                for took, number, kind, text in sorted(self.lineList, reverse = True)
+            ],
+        }
+
+    def report(self, where):
+        res = self.summary()
+        if where != '-':
+            import json
+            with open(where, 'w') as f:
+                json.dump(res, f, indent=2)
+            return
+
+        ms = lambda sec: f"{1000 * sec:.1f}"
+        stageList = [stage for stage in ['parse', 'line_format', 'highlight', 'code_wrap', 'text_wrap', 'format_table', 'emit_h', 'write'] if stage in res['stages']]
+        rendering = res['stages'].get('parse', {}).get('total', 0) or 1
+        out = [
+            f"{res['lines']} lines in {res['seconds']:.2f}s, {ms(rendering)}ms of it rendering",
+            f"{'stage':14s}{'calls':>8s}{'total ms':>11s}{'own ms':>10s}{'own %':>7s}",
+        ]
+        for stage in stageList:
+            entry = res['stages'][stage]
+            out.append(f"{stage:14s}{entry['calls']:8d}{ms(entry['total']):>11s}{ms(entry['own']):>10s}{100 * entry['own'] / rendering:6.0f}%")
+
+        out.append("")
+        out.append(f"{'own ms':14s}{'lines':>8s}" + "".join(f"{stage:>13s}" for stage in stageList))
+        for kind, block in sorted(res['blocks'].items(), key = lambda x: -x[1].get('total', 0)):
+            out.append(f"{kind:14s}{block['lines']:8d}" + "".join(f"{ms(block['own'].get(stage, 0)):>13s}" for stage in stageList))
+
+        out.append("")
+        out.append("slowest lines")
+        for entry in res['slowest']:
+            # cut before repr so an escape in the line stays whole
+            text = entry['text'] if visible_length(entry['text']) <= 60 else truncate(entry['text'], 60)
+            out.append(f"  {ms(entry['seconds']):>8s}ms  line {entry['line']:<6d}{entry['kind']:8s}{text!r}")
+        print("\n".join(out), file=sys.stderr)
+
+class Renderer:
+    # Everything needed to render one stream: its own parse state, palette, width
+    # and where the output goes. You can have as many of these going at once as you
+    # like, in as many threads as you like, as long as each one is only fed from one.
+    #
+    #   r = Renderer(width = 80)
+    #   for chunk in llm:
+    #       sys.stdout.write(r.feed(chunk))
+    #   sys.stdout.write(r.close())
+    #
+    # If out is given (anything with write and flush) the output goes there instead, in
+    # frames (see FrameWriter), and feed hands back an empty string.
+    def __init__(self, config = None, base = None, width = 0, out = None):
+        self.settings = resolved = settings(config, base)
+        self.style = style = Style()
+        self.state = state = ParseState(style)
+        self.output = []
+        self.codepads = {}
+        self.stats = None
+        self.profile = None
+        self.imageList = []     # (future, deadline, url) for images that haven't been drawn
+        self.saveList = []      # (text, language) for savebrace, see save_blocks
+        self.decoder = codecs.getincrementaldecoder('utf-8')(errors='replace')
+
+        for attr, value in resolved['style'].items():
+            setattr(style, attr, value)
+        for attr, value in resolved['features'].items():
+            setattr(state, attr, value)
+
+        self.out = out
+        if out and not isinstance(out, FrameWriter):
+            self.out = FrameWriter(out, state.FrameInterval, state.FrameBytes, None if state.SyncUpdate else False)
+
+        state.WidthArg = width or style.Width or 0
+        self.width_calc()
+
+    def debug_write(self, data, idle = False):
+        # The input goes to a capture so it can be played back later with --replay
+        state = self.state
+        if state.Logging:
+            if state.Logging == True:
+                fd, path = tempfile.mkstemp(dir=gettmpdir(), prefix="dbg", suffix=".sdcap")
+                os.close(fd)
+                state.Logging = capture.Capture(path, state.LoggingSize * 2**20)
+            if idle:
+                state.Logging.idle()
+            else:
+                state.Logging.write(data)
+
+    def savebrace(self, language = None):
+        state = self.state
+        # one that's over the size limit wouldn't be kept anyway
+        if state.Savebrace and 0 < len(state.code_buffer_raw) <= state.SavebraceSize * 2**20 and os.name != 'nt':
+            self.saveList.append((str(state.code_buffer_raw), language))
+
+    def save_blocks(self):
+        # Taking the lock and rewriting the index for every inline snippet adds up, so the
+        # blocks go in together when we'd be waiting on the input anyway, and at the end
+        state = self.state
+        if self.saveList:
+            store = Store(os.path.join(gettmpdir(), 'savebrace'), state.SavebraceBlocks, state.SavebraceSize * 2**20)
+            store.append(self.saveList)
+            self.saveList = []
+
+    def format_table(self, rowList, col_width_list = None):
+        state, style = self.state, self.style
+        num_cols = len(rowList)
+        row_height = 0
+        wrapped_cellList = []
+
+        if col_width_list is None:
+            # Calculate max width per column (integer division)
+            # Subtract num_cols + 1 for the vertical borders '│'
+            available_width = state.current_width() - (num_cols * 2)
+
+            width_base = available_width // num_cols
+            width_mod  = available_width % num_cols
+
+            col_width_list = [width_base + (1 if i < width_mod else 0) for i in range(num_cols)]
+        bg_color = style.Mid if state.in_table == style.Head else style.Dark
+        state.bg = f"{BG}{bg_color}"
+
+        # First Pass: Wrap text and calculate row heights
+        # Note this is where every cell is formatted so if 
+        # you are styling, do it before here!
+        for ix in range(len(rowList)):
+            row = rowList[ix]
+            wrapped_cell = self.text_wrap(row, width=col_width_list[ix], force_truncate=True, preserve_format=True)
+
+            # Ensure at least one line, even for empty cells
+            if not wrapped_cell:
+                wrapped_cell = [""]
+
+            wrapped_cellList.append(wrapped_cell)
+            row_height = max(row_height, len(wrapped_cell))
+
+        # --- Second Pass: Format and emit rows ---
+        for ix in range(row_height):
+            # This is the fancy row separator
+            extra = f"\033[4;58;2;{style.Mid}" if not state.in_table == style.Head and (ix == row_height - 1) else ""
+            line_segments = []
+
+            # Now we want to snatch this row index from all our cells
+            for iy in range(len(wrapped_cellList)):
+                cell = wrapped_cellList[iy]
+                segment = ''
+                if ix < len(cell):
+                    segment = cell[ix]
+
+                # Margin logic is correctly indented here
+                margin_needed = col_width_list[iy] - visible_length(segment)
+                margin_segment = segment + (" " * max(0, margin_needed))
+                line_segments.append(f"{BG}{bg_color}{extra} {margin_segment}")
+
+            # Correct indentation: This should be outside the c_idx loop
+            joined_line = f"{BG}{bg_color}{extra}{FG}{style.Symbol}│{RESET}".join(line_segments)
+            # Correct indentation and add missing characters
+            yield f"{state.space_left()}{FGRESET}{joined_line}{RESET}"
+
+        state.bg = BGRESET
+
+    def table_layout(self, natural):
+        # This is more or less what browsers do. Every column gets its longest word, but
+        # no more than an even share, and then what's left is handed out by how much
+        # wider than that each one would like to be. If it all fits, the rest is spread
+        # out evenly so the table still goes all the way across.
+        num_cols = len(natural)
+        available = self.state.current_width() - (num_cols * 2)
+        # text_wrap wants a column to spare
+        widest = [width + 1 for width, _ in natural]
+        least = [min(word + 1, width, max(1, available // num_cols)) for width, (_, word) in zip(widest, natural)]
+
+        want = sum(widest) - sum(least)
+        if sum(widest) <= available:
+            col_width_list = widest
+        elif want == 0:
+            # nobody wants more than they've got, like a table of empty cells that's too narrow
+            col_width_list = list(least)
+        else:
+            extra = available - sum(least)
+            # too narrow for even the least, but every column still gets something
+            col_width_list = [max(1, low + (high - low) * extra // want) for low, high in zip(least, widest)]
+
+        # the rounding goes to whoever wants it most, otherwise everyone
+        spare = available - sum(col_width_list)
+        spreadList = sorted(range(num_cols), key = lambda ix: col_width_list[ix] - widest[ix]) if col_width_list is not widest else list(range(num_cols))
+        for ix in range(max(0, spare)):
+            col_width_list[spreadList[ix % num_cols]] += 1
+        return col_width_list
+
+    def table_row(self, cells):
+        # The first TableRows rows (or whatever comes in TableWait seconds) are held back
+        # so the column widths can go by what's in them. The clock only counts for input
+        # that's coming in live, a file or a replay comes out the same however fast it's
+        # read. After that rows go straight out,
+        # and the widths only change when a cell comes along that's wider than both its
+        # column and anything that was gone by. Only the widest so far of each column is
+        # kept so a long table doesn't take up memory.
+        state = self.state
+        natural = state.table_natural
+        widthList = []
+        for ix, cell in enumerate(cells):
+            width, word = cell_width(cell)
+            widthList.append(width)
+            if ix == len(natural):
+                natural.append([width, word])
+            elif width > natural[ix][0] or word > natural[ix][1]:
+                natural[ix] = [max(width, natural[ix][0]), max(word, natural[ix][1])]
+
+        if state.table_basis is None:
+            if not state.table_rows:
+                state.table_since = time.monotonic()
+            state.table_rows.append((cells, state.in_table, state.block_depth))
+            live = state.is_pty or state.is_exec
+            if len(state.table_rows) >= state.TableRows or (live and time.monotonic() - state.table_since >= state.TableWait):
+                yield from self.table_release()
+            return
+
+        basis = state.table_basis
+        col_width_list = self.table_layout(basis[:len(cells)]) if len(cells) <= len(basis) else None
+        if col_width_list is None or any(width >= col_width_list[ix] and width > basis[ix][0] for ix, width in enumerate(widthList)):
+            state.table_basis = [list(pair) for pair in natural]
+            col_width_list = self.table_layout(state.table_basis[:len(cells)])
+        yield from self.format_table(cells, col_width_list)
+
+    def table_release(self):
+        # Whatever rows are being held back go out, and from here on the column widths
+        # go by what was in them. By now the line after them may have changed the
+        # blockquote depth so each goes out at the one it came in at.
+        state = self.state
+        state.table_basis = [list(pair) for pair in state.table_natural]
+        rowList, state.table_rows = state.table_rows, []
+        in_table, block_depth = state.in_table, state.block_depth
+        for cells, state.in_table, state.block_depth in rowList:
+            yield from self.format_table(cells, self.table_layout(state.table_basis[:len(cells)]))
+        state.in_table, state.block_depth = in_table, block_depth
+
+    def table_flush(self):
+        # For when the input's gone quiet or is over
+        for chunk in self.table_release():
+            self.emit_chunk(chunk)
+
+    def emit_h(self, level, text):
+        state, style = self.state, self.style
+        text = self.line_format(text)
+        lineList = self.text_wrap(text)
+        res = []
+        for text in lineList:
+            spaces_to_center = (state.current_width() -  visible_length(text)) / 2
+            if level == 1:      #
+                res.append(f"{state.space_left()}\n{state.space_left()}{BOLD[0]}{' ' * math.floor(spaces_to_center)}{text}{BOLD[1]}\n")
+            elif level == 2:    ##
+                res.append(f"{state.space_left()}\n{state.space_left()}{BOLD[0]}{FG}{style.Bright}{' ' * math.floor(spaces_to_center)}{text}{' ' * math.ceil(spaces_to_center)}{BOLD[1]}{FGRESET}")
+            elif level == 3:    ###
+                res.append(f"{state.space_left()}{FG}{style.Head}{BOLD[0]}{text}{BOLD[1]}{FGRESET}")
+            elif level == 4:    ####
+                res.append(f"{state.space_left()}{FG}{style.Symbol}{BOLD[0]}{text}{BOLD[1]}{FGRESET}")
+            elif level == 5:    #####
+                res.append(f"{state.space_left()}{text}{FGRESET}")
+            else: 
+                res.append(f"{state.space_left()}{FG}{style.Grey}{text}{FGRESET}")
+        return "\n".join(res)
 
-        oldword = word
+    def code_wrap(self, text_in):
+        state, style = self.state, self.style
+        if not style.PrettyBroken and state.WidthWrap and len(text_in) > state.full_width():
+            return (0, [text_in])
 
-    if len(lines) < 1:
-        return []
+        # get the indentation of the first line
+        indent = len(text_in) - len(text_in.lstrip())
+        text = text_in.lstrip()
+        mywidth = state.full_width(-4 if style.PrettyBroken else 0) - indent
 
-    if len(lines) == 1:
-        lines[0] = lines[0].rstrip()
+        # We take special care to preserve empty lines
+        if len(text) == 0:
+            return (0, [text_in])
+        res = [text[:mywidth]]
 
-    return lines
+        for i in range(mywidth, len(text), mywidth):
+            res.append(text[i : i + mywidth])
 
-def cjk_count(s):
-    cjk_re = re.compile(
-        r'[\u4E00-\u9FFF'      # CJK Unified Ideographs
-        r'\u3400-\u4DBF'       # CJK Unified Ideographs Extension A
-        r'\uF900-\uFAFF'       # CJK Compatibility Ideographs
-        r'\uFF00-\uFFEF'       # CJK Compatibility Punctuation
-        r'\u3000-\u303F'      # CJK Symbols and Punctuation
-        r'\U0002F800-\U0002FA1F]' # CJK Compatibility Ideographs Supplement
-    )
-    
-    return len(cjk_re.findall(visible(s)))
+        # sometimes just a newline wraps ... this isn't what we want actually
+        if res[-1].strip() == '':
+            res.pop()
 
-def line_format(line):
-    not_text = lambda token: not (token.isalnum() or token in ['\\','"']) or cjk_count(token)
-    footnotes = lambda match: ''.join([chr(SUPER[int(i)]) for i in match.group(1)])
+        return (indent, res)
 
-    def process_images(match):
-        url = match.group(2)
-        try:
-            if re.match(r"https://", url.lower()):
-                image = from_url(url)
-            else: 
-                image = from_file(url)
-            image.height = 20
-            print(f"{image:|.-1#}")
-        except:
-            return match.group(2)
-
-    # Apply OSC 8 hyperlink formatting after other formatting
-    def process_links(match):
-        description = match.group(1)
-        url = match.group(2)
-        return f'{LINK[0]}{url}\033\\{Style.Link}{description}{UNDERLINE[1]}{LINK[1]}{FGRESET}'
-
-    line = re.sub(r"\!\[([^\]]*)\]\(([^\)]+)\)", process_images, line)
-    line = re.sub(r"\[([^\]]+)\]\(([^\)]+)\)", process_links, line)
-    line = re.sub(r"\[\^(\d+)\]:?", footnotes, line)
-
-    tokenList = re.finditer(r"((~~|\*\*_|_\*\*|\*{1,3}|_{1,3}|`+)|[^~_*`]+)", line)
-    result = ""
-
-    last_pos = 0
-    for match in tokenList:
-        if match.span()[0] > last_pos:
-            result += line[last_pos:match.span()[0]]
-
-        last_pos = match.span()[1]
-        token = re.sub(r'\s+',' ', match.group(1))
-        next_token = line[match.end()] if match.end() < len(line) else ""
-        prev_token = line[match.start()-1] if match.start() > 0 else ""
-
-        # This trick makes sure that things like `` ` `` render right.
-        if "`" in token and (not state.inline_code or state.inline_code == token):
-            if state.inline_code:
-                if ' ' in state.inline_code:
-                    savebrace()
-                state.inline_code = False
-            else:
-                state.inline_code = token
-                state.code_buffer_raw = ''
 
-            if state.inline_code:
-                result += f'{BG}{Style.Mid}'
+    def text_wrap(self, text, width = -1, indent = 0, first_line_prefix="", subsequent_line_prefix="", force_truncate=False, preserve_format=False):
+        state = self.state
+        if width == -1:
+            width = state.Width
+
+        # The empty word clears the buffer at the end.
+        formatted = self.line_format(text)
+        words = split_text(formatted) + [""]
+
+        lines = []
+        current_line = ""
+        current_style = []
+        resetter = "" if preserve_format else FORMATRESET 
+    
+        # We keep a running width of the current line rather than measuring it
+        # for every word. An escape that's been split between words can only be
+        # measured in context though, so then we do it the slow way.
+        current_width = 0
+        exact = True
+        oldword_cjk = 0
+        for word in words:
+            # we apply the style if we see it at the beginning of the word
+            codes = extract_ansi_codes(word)
+            if len(codes) and word.startswith(codes[0]):
+                # this pop(0) is intentional
+                current_style.append(codes.pop(0))
+
+            word_visible = visible(word)
+            word_width = display_width(word_visible)
+            word_cjk = cjk_count(word)
+            if '\x1b' in word_visible:
+                exact = False
+            if not exact:
+                current_width = visible_length(current_line)
+
+            if len(word) and current_width + word_width + 1 <= width:  # +1 for space
+                space = ""
+                if len(word_visible) > 0 and current_line:
+                    space = " "
+                if (":" in word_visible or word_cjk) and oldword_cjk:
+                    space = ""
+                current_line += space + word
+                current_width += len(space) + word_width
             else:
-                result += state.bg
-                state.code_buffer_raw = ''
+                # Word doesn't fit, finalize the previous line
+                prefix = first_line_prefix if not lines else subsequent_line_prefix
+                line_content = prefix + current_line  
+                line_width = visible_length(line_content)
+                if force_truncate and line_width >= width:
+                    line_content = truncate(line_content, width)
+                    line_width = visible_length(line_content)
+
+                margin = max(0, width - line_width)
+
+                if line_content.strip() != "":
+                    # We make absolutely positively sure beyond any doubt
+                    # that we have closed our hyperlink OSC
+                    if LINK[0] in line_content:
+                        line_content += LINK[1]
+                    lines.append(line_content + resetter + state.bg + ' ' * margin)
+
+                current_line = (" " * indent) + "".join(current_style) + word
+                current_width = visible_length(current_line)
+                exact = '\x1b' not in visible(current_line)
+
+            if len(codes):
+                current_style += codes
+
+            if codes:
+                current_style = ansi_collapse(current_style, codes)
+
+            oldword_cjk = word_cjk
+
+        if len(lines) < 1:
+            return []
+
+        if len(lines) == 1:
+            lines[0] = lines[0].rstrip()
+
+        return lines
+
+    def code_lexer(self):
+        state, style = self.state, self.style
+        state.lexer, state.formatter, _ = code_tools(state.code_language, style.Syntax, style.DarkHex)
+        state.highlighter = Highlighter(state.lexer, state.formatter)
+
+    def code_highlight(self, tline):
+        state = self.state
+        this_batch = None
+        highlighted_code = state.highlighter.highlight(tline)
+        if highlighted_code is not None:
+            this_batch = code_snip(highlighted_code, tline, whole = state.highlighter.anchor == 0)
+
+        if this_batch is None:
+            # The anchored window didn't have enough in it to find our place
+            from pygments import highlight
+            this_batch = code_snip(highlight(state.code_buffer + tline, state.lexer, state.formatter), tline)
+        return this_batch
+
+    def line_format(self, line):
+        state, style = self.state, self.style
+        not_text = lambda token: not (token.isalnum() or token in ['\\','"']) or cjk_count(token)
+        footnotes = lambda match: ''.join([chr(SUPER[int(i)]) for i in match.group(1)])
+
+        def process_images(match):
+            # The url stays where the image was as a placeholder and the image itself
+            # shows up once it's loaded, see draw_images
+            url = match.group(2)
+            future = image_pool().submit(load_image, url, 20, state.ImageTimeout, state.ImageCache)
+            self.imageList.append((future, time.monotonic() + state.ImageTimeout, url))
+            return url
+
+        # Apply OSC 8 hyperlink formatting after other formatting
+        def process_links(match):
+            description = match.group(1)
+            url = match.group(2)
+            return f'{LINK[0]}{url}\033\\{style.Link}{description}{UNDERLINE[1]}{LINK[1]}{FGRESET}'
+
+        line = re.sub(r"\!\[([^\]]*)\]\(([^\)]+)\)", process_images, line)
+        line = re.sub(r"\[([^\]]+)\]\(([^\)]+)\)", process_links, line)
+        line = re.sub(r"\[\^(\d+)\]:?", footnotes, line)
+
+        tokenList = re.finditer(r"((~~|\*\*_|_\*\*|\*{1,3}|_{1,3}|`+)|[^~_*`]+)", line)
+        result = ""
+
+        last_pos = 0
+        for match in tokenList:
+            if match.span()[0] > last_pos:
+                result += line[last_pos:match.span()[0]]
+
+            last_pos = match.span()[1]
+            token = re.sub(r'\s+',' ', match.group(1))
+            next_token = line[match.end()] if match.end() < len(line) else ""
+            prev_token = line[match.start()-1] if match.start() > 0 else ""
+
+            # This trick makes sure that things like `` ` `` render right.
+            if "`" in token and (not state.inline_code or state.inline_code == token):
+                if state.inline_code:
+                    if ' ' in state.inline_code:
+                        self.savebrace()
+                    state.inline_code = False
+                else:
+                    state.inline_code = token
+                    state.code_buffer_raw = CodeBuffer()
+
+                if state.inline_code:
+                    result += f'{BG}{style.Mid}'
+                else:
+                    result += state.bg
+                    state.code_buffer_raw = CodeBuffer()
    
-        # This is important here because we ignore formatting
-        # inside of our code block.
-        elif state.inline_code:
-            result += token
-            state.code_buffer_raw += token
-
-        elif token == '~~' and (state.in_strikeout or not_text(prev_token)):
-            state.in_strikeout = not state.in_strikeout
-            result += STRIKEOUT[0] if state.in_strikeout else STRIKEOUT[1]
-
-        elif token in ['**_','_**','___','***'] and (state.in_bold or not_text(prev_token)):
-            state.in_bold = not state.in_bold
-            result += BOLD[0] if state.in_bold else BOLD[1]
-            state.in_italic = not state.in_italic
-            result += ITALIC[0] if state.in_italic else ITALIC[1]
-
-        elif (token == '__' or token == "**") and (state.in_bold or not_text(prev_token)):
-            state.in_bold = not state.in_bold
-            result += BOLD[0] if state.in_bold else BOLD[1]
- 
-        elif token == "*" and (state.in_italic or not_text(prev_token)):
-            # This is the use case of talking about * and then following
-            # up on something as opposed to *like this*.
-            if state.in_italic or (not state.in_italic and next_token != ' '):
+            # This is important here because we ignore formatting
+            # inside of our code block.
+            elif state.inline_code:
+                result += token
+                state.code_buffer_raw += token
+
+            elif token == '~~' and (state.in_strikeout or not_text(prev_token)):
+                state.in_strikeout = not state.in_strikeout
+                result += STRIKEOUT[0] if state.in_strikeout else STRIKEOUT[1]
+
+            elif token in ['**_','_**','___','***'] and (state.in_bold or not_text(prev_token)):
+                state.in_bold = not state.in_bold
+                result += BOLD[0] if state.in_bold else BOLD[1]
                 state.in_italic = not state.in_italic
                 result += ITALIC[0] if state.in_italic else ITALIC[1]
+
+            elif (token == '__' or token == "**") and (state.in_bold or not_text(prev_token)):
+                state.in_bold = not state.in_bold
+                result += BOLD[0] if state.in_bold else BOLD[1]
+ 
+            elif token == "*" and (state.in_italic or not_text(prev_token)):
+                # This is the use case of talking about * and then following
+                # up on something as opposed to *like this*.
+                if state.in_italic or (not state.in_italic and next_token != ' '):
+                    state.in_italic = not state.in_italic
+                    result += ITALIC[0] if state.in_italic else ITALIC[1]
+                else:
+                    result += token
+
+            elif token == "_" and (state.in_underline or (not_text(prev_token) and next_token.isalnum())):
+                state.in_underline = not state.in_underline
+                result += UNDERLINE[0] if state.in_underline else UNDERLINE[1]
             else:
                 result += token
 
-        elif token == "_" and (state.in_underline or (not_text(prev_token) and next_token.isalnum())):
-            state.in_underline = not state.in_underline
-            result += UNDERLINE[0] if state.in_underline else UNDERLINE[1]
-        else:
-            result += token
-
-    return result
-
-def parse(stream):
-    last_line_empty_cache = None
-    byte = None
-    TimeoutIx = 0
-    lexer = None
-    while True:
-        if state.is_pty or state.is_exec:
-            byte = None
-            ready_in, _, _ = select.select(
-                    [stream.fileno(), state.exec_master], [], [], state.Timeout)
-
-            if state.is_exec: 
-                # This is keyboard input
-                if stream.fileno() in ready_in:
-                    byte = os.read(stream.fileno(), 1)
-
-                    state.exec_kb += 1
-                    os.write(state.exec_master, byte)
-
-                    if byte in [b'\n', b'\r']:
-                        state.buffer = b''
-                        print("")
-                        state.exec_kb = 0
-                    else:
-                        continue
+        return result
+
+    def readlines(self, stream):
+        state = self.state
+        # We read whatever is available and hand back complete lines. A multibyte
+        # character can be split across reads so the decoder holds on to the tail.
+        TimeoutIx = 0
+        # read() on a buffered file waits for all ReadSize of it, read1() hands back
+        # whatever's there, so a slow pipe or fifo given as a file still streams
+        read = getattr(stream, 'read1', stream.read)
+        while True:
+            chunk = None
+            if state.is_pty or state.is_exec:
+                ready_in = self.wait([stream.fileno(), state.exec_master], state.Timeout)
+
+                if state.is_exec: 
+                    # This is keyboard input. We take all of it that's there and hand it to
+                    # the program in one go, a paste or fast typing doesn't mean a trip
+                    # around this loop for every key.
+                    if stream.fileno() in ready_in:
+                        keys = os.read(stream.fileno(), ReadSize)
+                        sent = 0
+                        while sent < len(keys):
+                            sent += os.write(state.exec_master, keys[sent:])
+
+                        # what's after the last enter is what's being typed now
+                        enter = max(keys.rfind(b'\n'), keys.rfind(b'\r'))
+                        if enter == -1:
+                            state.exec_kb += len(keys)
+                            continue
 
-                if state.exec_master in ready_in:
-                    TimeoutIx = 0
-                    byte = os.read(state.exec_master, 1)
+                        state.buffer = ''
+                        self.write("\n" * (keys.count(b'\n') + keys.count(b'\r')))
+                        state.exec_kb = len(keys) - enter - 1
+                        if state.exec_kb:
+                            continue
+                        chunk = keys[enter:]
 
-                    if state.exec_kb:
-                        os.write(sys.stdout.fileno(), byte)
+                    if state.exec_master in ready_in:
+                        TimeoutIx = 0
+                        chunk = os.read(state.exec_master, ReadSize)
 
-                if len(ready_in) == 0:
-                    TimeoutIx += 1
+                        if state.exec_kb:
+                            self.collect()
+                            os.write(sys.stdout.fileno(), chunk)
 
-            elif stream.fileno() in ready_in: 
-                byte = os.read(stream.fileno(), 1)
-                TimeoutIx = 0
-            elif TimeoutIx == 0:
-                # This is our record separator for debugging - hands peaking
-                debug_write("🫣".encode('utf-8'))
-                TimeoutIx += 1
+                    if len(ready_in) == 0:
+                        TimeoutIx += 1
 
-        else:
-            byte = stream.read(1)
-
-        if byte is not None:
-            if byte == b'': break
-            state.buffer += byte
-            debug_write(byte)
+                elif stream.fileno() in ready_in: 
+                    chunk = os.read(stream.fileno(), ReadSize)
+                    TimeoutIx = 0
+                elif TimeoutIx == 0:
+                    # so a replay gets a timeout here too
+                    self.debug_write(None, idle = True)
+                    TimeoutIx += 1
 
-        if not (byte == b'\n' or byte is None): continue
+            else:
+                # this can block so what's been rendered goes out first
+                if self.out:
+                    self.out.flush()
+                self.save_blocks()
+                # read1 still sits there on a quiet fifo, so while there's an image
+                # loading we look in every Timeout to draw it once it's ready
+                while self.imageList and not isinstance(stream, BytesIO) and not select.select([stream], [], [], state.Timeout)[0]:
+                    self.draw_images()
+                    if self.out:
+                        self.out.flush()
+                chunk = read(ReadSize)
+
+            # A timeout, the partial line may be a prompt
+            if chunk is None:
+                if state.buffer:
+                    yield state.buffer
+                continue
 
-        line = state.buffer.decode('utf-8').replace('\t','  ')
+            if chunk == b'': break
+            self.debug_write(chunk)
+            text = self.decoder.decode(chunk)
+            if self.stats:
+                self.stats.arrived(len(chunk), len(text))
+            yield from self.lines(text)
+
+    def wait(self, fdList, timeout):
+        # select, except if we'd actually have to wait, whatever output is
+        # being held back goes out first
+        if self.out and self.out.pending:
+            ready_in, _, _ = select.select(fdList, [], [], 0)
+            if ready_in:
+                return ready_in
+            self.out.flush()
+        self.save_blocks()
+        if self.stats:
+            start = time.perf_counter()
+        ready_in, _, _ = select.select(fdList, [], [], timeout)
+        if self.stats:
+            self.stats.select_wait += time.perf_counter() - start
+        if not ready_in:
+            # the input's gone quiet. Table rows that have waited long enough and
+            # images that have loaded since the last line go out now
+            if self.state.table_rows and time.monotonic() - self.state.table_since >= self.state.TableWait:
+                self.table_flush()
+            if self.imageList:
+                self.draw_images()
+            if self.out:
+                self.out.flush()
+        return ready_in
+
+    def lines(self, text):
+        # Hands back the complete lines in text and holds on to the rest
+        state = self.state
+        if '\n' not in text:
+            state.buffer += text
+            return []
+
+        lineList = text.split('\n')
+        lineList[0] = state.buffer + lineList[0]
+        state.buffer = lineList.pop()
+        return [line + '\n' for line in lineList]
+
+    def parse(self, stream):
+        for line in self.readlines(stream):
+            yield from self.parse_line(line)
+
+    def parse_line(self, line):
+        state, style = self.state, self.style
+        line = line.replace('\t','  ')
         state.has_newline = line.endswith('\n')
+        state.line_no += state.has_newline
         # I hate this. There should be better ways.
         state.maybe_prompt = not state.has_newline and state.current()['none'] and re.match(r'^.*>\s+$', visible(line))
 
@@ -630,29 +1774,31 @@ def parse(stream):
             state.emit_flag = Code.Flush
             yield line
             state.current_line = ''
-            state.buffer = b''
+            state.buffer = ''
 
         if not state.has_newline:
-            continue
+            return
 
-        state.buffer = b''
         """
         # Run through the plugins first
-        res = latex.Plugin(line, state, Style)
+        res = latex.Plugin(line, state, style)
         if res is True:
             # This means everything was consumed by our plugin and 
             # we should continue
-            continue
+            return
         elif res is not None:
             for row in res:
                 yield row
-                continue
+            return
         """
-        
+    
         # running this here avoids stray |
-        block_match = re.match(r"^\s*((>\s*)+|<.?think>)", line)
-        if not state.in_code and block_match:
+        block_match = not state.in_code and line.lstrip()[:1] in ('>', '<') and BLOCKQUOTE_RE.match(line)
+        if block_match:
             if block_match.group(1) == '</think>':
+                # rows held back from inside it go out before it's closed
+                if state.table_rows:
+                    yield from self.table_release()
                 state.block_depth = 0
                 yield RESET
             elif block_match.group(1) == '<think>':
@@ -663,6 +1809,8 @@ def parse(stream):
                 line = line[len(block_match.group(0)):]
         else:
             if state.block_depth > 0:
+                if state.table_rows:
+                    yield from self.table_release()
                 yield FGRESET
                 state.block_depth = 0
 
@@ -671,15 +1819,19 @@ def parse(stream):
             is_empty = line.strip() == ""
 
             if is_empty and state.last_line_empty:
-                continue  # Skip processing this line
+                return  # Skip processing this line
             elif is_empty:
                 state.last_line_empty = True
+                if state.table_rows:
+                    yield from self.table_release()
+                if self.stats:
+                    self.stats.block('empty')
                 yield state.space_left()
-                continue
+                return
             else:
-                last_line_empty_cache = state.last_line_empty
+                state.last_line_empty_cache = state.last_line_empty
                 state.last_line_empty = False
-        
+    
         # This is to reset our top-level line-based systems
         # \n buffer
         if not state.in_list and len(state.ordered_list_numbers) > 0:
@@ -697,62 +1849,68 @@ def parse(stream):
 
 
         # Indent guaranteed
+        kind, match = classify(line)
+        if self.stats or self.profile:
+            block = 'code' if state.in_code else kind or ('list' if state.in_list else 'prose')
+            if self.stats:
+                self.stats.block(block)
+            if self.profile:
+                self.profile.kind = block
 
         # in order to stream tables and keep track of the headers we need to know whether
         # we are in table or not table otherwise > 1 tables won't have a stylized header
-        if state.in_table and not state.in_code and not re.match(r"^\s*\|.+\|\s*$", line):
+        if state.in_table and not state.in_code and kind != 'table':
+            yield from self.table_release()
             state.in_table = False
 
         # <code><pre>
         if not state.in_code:
-            code_match = re.match(r"^\s*(```|<pre>)\s*([^\s]+|$)\s*$", line)
-            if code_match:
+            if kind == 'fence':
                 state.in_code = Code.Backtick
                 state.code_indent = len(line) - len(line.lstrip())
-                state.code_language = code_match.group(2) or 'Bash'
+                state.code_language = match.group('language') or 'Bash'
 
-            elif state.CodeSpaces and last_line_empty_cache and not state.in_list:
-                code_match = re.match(r"^    \s*[^\s\*]", line)
-                if code_match:
+            elif state.CodeSpaces and state.last_line_empty_cache and not state.in_list:
+                if CODESPACES_RE.match(line):
                     state.in_code = Code.Spaces
                     state.code_language = 'Bash'
 
             if state.in_code:
-                state.code_buffer = state.code_buffer_raw = ""
+                state.code_buffer = ""
+                state.code_buffer_raw = CodeBuffer()
                 state.code_gen = 0
+                state.code_line_no = state.line_no
                 state.code_first_line = True
-                state.bg = f"{BG}{Style.Dark}"
+                state.bg = f"{BG}{style.Dark}"
                 state.where_from = "code pad"
-                if Style.PrettyPad or Style.PrettyBroken:
-                    if not Style.PrettyPad:
+                if style.PrettyPad or style.PrettyBroken:
+                    if not style.PrettyPad:
                         yield ""
 
-                    yield Style.Codepad[0]
+                    yield style.Codepad[0]
                 else:
                     yield ""
 
                 logging.debug(f"In code: ({state.in_code})")
 
                 if state.in_code == Code.Backtick:
-                    continue
+                    return
 
         if state.in_code:
             try:
                 # This is turning it OFF
                 if ( (                     state.in_code == Code.Backtick and     line.strip() in ["</pre>", "```"]  ) or 
                      (state.CodeSpaces and state.in_code == Code.Spaces   and not line.startswith('    ')) ):
+                    # before the scrape thread has the buffer, it can be in a file we'd both be seeking in
+                    self.savebrace(state.code_language)
                     if state.scrape:
-                        ext = "sh"
-                        try:
-                            ext = get_lexer_by_name(state.code_language).filenames[0].split('.')[-1]
-                        except:
+                        ext = code_tools(state.code_language, style.Syntax, style.DarkHex)[2]
+                        if not ext:
                             logging.warning(f"Can't find canonical extension for {state.code_language}")
-                            pass
+                            ext = "sh"
 
-                        open(os.path.join(state.scrape, f"file_{state.scrape_ix}.{ext}"), 'w').write(state.code_buffer_raw)
-                        state.scrape_ix += 1
+                        state.scrape.add(state.code_buffer_raw, state.code_language, ext, state.source, state.code_line_no)
 
-                    savebrace()
                     state.code_language = None
                     state.code_indent = 0
                     code_type = state.in_code
@@ -760,9 +1918,9 @@ def parse(stream):
                     state.bg = BGRESET
 
                     state.where_from = "code pad"
-                    if Style.PrettyPad or Style.PrettyBroken:
-                        yield Style.Codepad[1] 
-                        if not Style.PrettyPad:
+                    if style.PrettyPad or style.PrettyBroken:
+                        yield style.Codepad[1] 
+                        if not style.PrettyPad:
                             yield ""
 
                     else:
@@ -775,23 +1933,15 @@ def parse(stream):
                     #yield RESET
 
                     if code_type == Code.Backtick:
-                        continue
+                        return
                     else:
                         # otherwise we don't want to consume
                         # nor do we want to be here.
                         raise Goto()
 
-                if state.code_first_line or lexer is None:
+                if state.code_first_line or state.lexer is None:
                     state.code_first_line = False
-                    try:
-                        lexer = get_lexer_by_name(state.code_language)
-                        custom_style = override_background(Style.Syntax, ansi2hex(Style.Dark))
-                    except pygments.util.ClassNotFound as e:
-                        logging.debug(e)
-                        lexer = get_lexer_by_name("Bash")
-                        custom_style = override_background("default", ansi2hex(Style.Dark))
-
-                    formatter = TerminalTrueColorFormatter(style=custom_style)
+                    self.code_lexer()
                     if line.startswith(' ' * state.code_indent):
                         line = line[state.code_indent :]
 
@@ -806,113 +1956,61 @@ def parse(stream):
                     line = state.code_line
                     state.code_line = ''
                 else:
-                    continue
+                    return
 
-                highlighted_code = highlight(line, lexer, formatter)
-                indent, line_wrap = code_wrap(line)
-                
+                indent, line_wrap = self.code_wrap(line)
+            
                 state.where_from = "in code"
-                pre = [state.space_left(listwidth = True), '  '] if Style.PrettyBroken else ['', '']
+                pre = [state.space_left(listwidth = True), '  '] if style.PrettyBroken else ['', '']
 
                 for tline in line_wrap:
-                    # wrap-around is a bunch of tricks. We essentially format longer and longer portions of code. The problem is
-                    # the length can change based on look-ahead context so we need to use our expected place (state.code_gen) and
-                    # then naively search back until our visible_lengths() match. This is not fast and there's certainly smarter
-                    # ways of doing it but this thing is way trickery than you think
-                    highlighted_code = highlight(state.code_buffer + tline, lexer, formatter)
-                    #print("(",bytes(highlighted_code,'utf-8'),")")
-                    parts = split_up(highlighted_code)
-
-                    # Sometimes the highlighter will do things like a full reset or a background reset.
-                    # This is mostly not what we want
-                    parts = [ re.sub(r"\033\[[34]9(;00|)m", FORMATRESET, x) for x in parts]
-    
-                    # Since we are streaming we ignore the resets and newlines at the end
-                    while parts[-1] in [FGRESET, FORMATRESET]:
-                        parts.pop()
-
-                    tline_len = visible_length(tline)
-
-                    # now we find the new stuff:
-                    ttl = 0
-                    for i in range(len(parts)-1, 0, -1):
-                        idx = parts[i]
-                        if len(idx) == 0:
-                            continue
-
-                        ttl += len(idx) if idx[0] != '\x1b' else 0
-
-                        if ttl > 1+tline_len:
-                            break
-
-
-                    newlen = visible_length("".join(parts[i:]))
-
-                    snipfrom = newlen - len(tline) + 2
-                    # this is all getting replaced with the new lexer so let's give a cheap
-                    # fix for now:
-                    if snipfrom == 1:
-                        snipfrom = 0
-
-                    if snipfrom > 0:
-                        parts[i] = parts[i][snipfrom:]
-
+                    this_batch = self.code_highlight(tline)
                     state.code_buffer += tline
-                    this_batch = "".join(parts[i:])
-
-                    if this_batch.startswith(FGRESET):
-                        this_batch = this_batch[len(FGRESET) :]
-
-                    # clean it before prepending with potential format 
-                    this_batch = this_batch.strip()
-                    while i - 1 >= 0 and parts[i-1] and parts[i-1][0] == '\x1b':
-                         this_batch = parts[i-1] + this_batch
-                         i -= 1
-
-                    ## this is the crucial counter that will determine
-                    # the beginning of the next line
-                    state.code_gen = len(highlighted_code)
+                    if len(state.code_buffer) > 2 * Highlighter.Window:
+                        # it only needs to be enough to lex from, from the start of a line
+                        window = state.code_buffer[-Highlighter.Window:]
+                        state.code_buffer = window[window.find('\n') + 1:]
                     code_line = ' ' * indent + this_batch.strip()
 
                     margin = state.full_width( -len(pre[1]) ) - visible_length(code_line) % state.WidthFull
-                    yield f"{pre[0]}{Style.Codebg}{pre[1]}{code_line}{FORMATRESET}{' ' * max(0, margin)}{BGRESET}"  
-                continue
+                    yield f"{pre[0]}{style.Codebg}{pre[1]}{code_line}{FORMATRESET}{' ' * max(0, margin)}{BGRESET}"  
+                return
             except Goto:
                 pass
-            
+        
             except Exception as ex:
                 logging.warning(f"Code parsing error: {ex}")
                 traceback.print_exc()
                 pass
 
         # <table>
-        if re.match(r"^\s*\|.+\|\s*$", line) and not state.in_code:
+        if kind == 'table' and not state.in_code:
             cells = [c.strip() for c in line.strip().strip("|").split("|")]
 
             # This guarantees we are at the first line
             # \n buffer
             if not state.in_table:
-                state.in_table = Style.Head
+                state.in_table = style.Head
+                state.table_natural, state.table_basis = [], None
 
-            elif state.in_table == Style.Head:
+            elif state.in_table == style.Head:
                 # we ignore the separator, this is just a check
-                if not re.match(r"^[\s|:-]+$", line):
+                if not match.group('separator'):
                     logging.warning(f"Table definition row 2 was NOT a separator. Instead it was:\n({line})")
 
                 # Let's assume everything worked out I guess.
                 # We set our header to false and basically say we are expecting the body
                 state.in_table = Code.Body 
-                continue
+                return
 
-            yield from format_table(cells)
-            continue
+            yield from self.table_row(cells)
+            return
 
         # <li> <ul> <ol>
         # llama-4 maverick uses + and +- for lists ... for some reason
         content = line
         bullet = ' '
-        list_item_match = re.match(r"^(\s*)([\+*\-] |\+\-+|\d+\.\s+)(.*)", line)
-        if list_item_match:
+        if kind == 'list':
             # llama 4 maverick does this weird output like this
             # 1. blah blah blah
             #    this should be a list
@@ -924,13 +2022,13 @@ def parse(stream):
             #    still in the list
             # We do this here so that the first line which is the bullet
             # line gets the proper hang
-            state.list_indent_text = len(list_item_match.group(2)) - 1
+            state.list_indent_text = len(match.group('bullet')) - 1
             state.in_list = True
 
-            indent = len(list_item_match.group(1))
+            indent = len(match.group('indent'))
 
-            list_type = "number" if list_item_match.group(2)[0].isdigit() else "bullet"
-            content = list_item_match.group(3)
+            list_type = "number" if match.group('bullet')[0].isdigit() else "bullet"
+            content = match.group('content')
 
             # Handle stack
             while state.list_item_stack and state.list_item_stack[-1][0] > indent:
@@ -950,72 +2048,141 @@ def parse(stream):
 
             bullet = '•'
             if list_type == "number":
-                list_number = int(max(state.ordered_list_numbers[-1], float(list_item_match.group(2))))
+                list_number = int(max(state.ordered_list_numbers[-1], float(match.group('bullet'))))
                 bullet = str(list_number)
 
         # This is intentional ... we can get here in llama 4 using
         # a weird thing
         if state.in_list:
-            indent = (len(state.list_item_stack) - 1) * Style.ListIndent #+ (len(bullet) - 1)
-            wrap_width = state.current_width(listwidth = True) - Style.ListIndent
-            
-            wrapped_lineList = text_wrap(content, wrap_width, Style.ListIndent,
-                first_line_prefix = f"{(' ' * indent)}{FG}{Style.Symbol}{bullet}{RESET} ",
+            indent = (len(state.list_item_stack) - 1) * style.ListIndent #+ (len(bullet) - 1)
+            wrap_width = state.current_width(listwidth = True) - style.ListIndent
+        
+            wrapped_lineList = self.text_wrap(content, wrap_width, style.ListIndent,
+                first_line_prefix = f"{(' ' * indent)}{FG}{style.Symbol}{bullet}{RESET} ",
                 subsequent_line_prefix = " " * (indent)
             )
             for wrapped_line in wrapped_lineList:
                 yield f"{state.space_left()}{wrapped_line}\n"
 
-            continue
+            return
 
         # <h1> ... <h6>
-        header_match = re.match(r"^\s*(#{1,6})\s*(.*)", line)
-        if header_match:
-            level = len(header_match.group(1))
-            yield emit_h(level, header_match.group(2))
-            continue
+        if kind == 'header':
+            level = len(match.group('level'))
+            yield self.emit_h(level, match.group('title'))
+            return
 
         # <hr>
-        hr_match = re.match(r"^[\s]*([-\*=_]){3,}[\s]*$", line)
-        if hr_match:
-            if state.last_line_empty or last_line_empty_cache:
+        if kind == 'hr':
+            if state.last_line_empty or state.last_line_empty_cache:
                 # print a horizontal rule using a unicode midline 
-                yield f"{Style.MarginSpaces}{FG}{Style.Symbol}{'─' * state.Width}{RESET}"
+                yield f"{style.MarginSpaces}{FG}{style.Symbol}{'─' * state.Width}{RESET}"
             else:
                 # We tell the next level up that the beginning of the buffer should be a flag.
                 # Underneath this condition it will no longer yield
-                state.emit_flag = 1 if '-' in hr_match.groups(1) else 2
+                state.emit_flag = 1 if match.group('rule') == '-' else 2
                 yield ""
-            continue
+            return
 
         state.where_from = "emit_normal"
 
         # if we've gotten to an emit normal then we can assert that our list stack should
-        # be empty. This is a hack.
+        # be empty. This is a hack. The numbers go with it, otherwise the next list's count
+        # isn't the first one and never gets reset, and that'd depend on what came before.
         state.list_item_stack = []
+        state.ordered_list_numbers = []
 
         if len(line) == 0: yield ""
         if visible_length(line) < state.Width:
             # we want to prevent word wrap
-            yield f"{state.space_left()}{line_format(line.lstrip())}"
+            yield f"{state.space_left()}{self.line_format(line.lstrip())}"
         else:
-            wrapped_lines = text_wrap(line)
+            wrapped_lines = self.text_wrap(line)
             for wrapped_line in wrapped_lines:
                 yield f"{state.space_left()}{wrapped_line}\n"
 
-def emit(inp):
-    buffer = []
-    flush = False
-    for chunk in parse(inp):
-        width_calc()
+    def emit(self, inp):
+        for line in self.readlines(inp):
+            self.render(line)
+        self.flush()
+        self.collect()
+
+    def emit_file(self, path):
+        # A file argument. With RenderCache on, what it renders to is kept in renders/ in
+        # the user cache dir under its contents, the width, the settings and sd itself, so
+        # showing the same file again is only a copy. On a miss the only extra work is the
+        # hashing. The code blocks that went to savebrace and the last one for the clipboard
+        # are kept with it so a hit does the same. Files with images aren't kept since those
+        # depend on the terminal and come whenever they load. Anything that isn't a plain
+        # file, like a fifo, streams through like it would without the cache.
+        state = self.state
+        if not state.RenderCache or not os.path.isfile(path):
+            with open(path, 'rb') as f:
+                return self.emit(f)
+
+        with open(path, 'rb') as f:
+            data = f.read()
+        if b'![' in data:
+            return self.emit(BytesIO(data))
+
+        import hashlib, json
+        self.width_calc()
+        key = [hashlib.sha256(data).hexdigest(), state.WidthFull, state.WidthWrap, self.settings, sd_version()]
+        cache_path = cache_file('renders', key)
+        try:
+            with open(cache_path, encoding='utf-8') as f:
+                header = json.loads(f.readline())
+                text = f.read()
+            os.utime(cache_path)
+            state.code_buffer_raw = CodeBuffer(header['code'])
+            self.saveList += [tuple(block) for block in header['blocks']]
+            self.write(text)
+            self.save_blocks()
+            self.collect()
+            return
+        except (OSError, ValueError, KeyError, TypeError):
+            pass
+
+        pieceList = []
+        blockList = []
+        write, savebrace = self.write, self.savebrace
+        def tee(text):
+            pieceList.append(text)
+            write(text)
+        def keep(language = None):
+            size = len(self.saveList)
+            savebrace(language)
+            blockList.extend(self.saveList[size:])
+        self.write, self.savebrace = tee, keep
+        try:
+            self.emit(BytesIO(data))
+        finally:
+            self.write, self.savebrace = write, savebrace
+        code = '' if state.code_buffer_raw.spilled() else str(state.code_buffer_raw)
+        cache_put(cache_path, json.dumps({'code': code, 'blocks': blockList}) + '\n' + ''.join(pieceList), state.RenderCache * 2**20)
+
+    def render(self, line):
+        # so a resize takes effect on this line and not the one after
+        self.width_calc()
+        for chunk in self.parse_line(line):
+            self.emit_chunk(chunk)
+        # a partial line that wasn't a prompt is still waiting in the buffer
+        if self.stats and (line.endswith('\n') or not self.state.buffer):
+            self.stats.rendered(len(line), len(self.state.emit_buffer) > 0)
+
+    def emit_chunk(self, chunk):
+        state = self.state
+        buffer = state.emit_buffer
+        flush = False
+        self.width_calc()
         if state.emit_flag:
             if state.emit_flag == Code.Flush:
                 flush = True
                 state.emit_flag = None
             else:
-                buffer[0] = emit_h(state.emit_flag, buffer[0])
+                buffer[0] = self.emit_h(state.emit_flag, buffer[0])
                 state.emit_flag = None
-                continue
+                return
 
         if not state.has_newline:
             chunk = chunk.rstrip("\n")
@@ -1026,64 +2193,291 @@ def emit(inp):
             state.current_line = ''
         else:
             state.current_line += chunk
-            
+        
         buffer.append(chunk)
         # This *might* be dangerous
         state.reset_inline()
 
         if flush:
             chunk = "\n".join(buffer)
-            buffer = []
-            flush = False
+            buffer.clear()
 
         elif len(buffer) == 1:
-            continue
+            return
 
         else:
             chunk = buffer.pop(0)
 
-        print(chunk, end="", file=sys.stdout, flush=True)
-
-    if len(buffer):
-        print(buffer.pop(0), file=sys.stdout, end="", flush=True)
-
-def ansi2hex(ansi_code):
-    parts = ansi_code.strip('m').split(";")
-    r, g, b = map(int, parts)
-    return f"#{r:02x}{g:02x}{b:02x}"
-
-def apply_multipliers(style, name, H, S, V):
-    m = style.get(name)
-    r, g, b = colorsys.hsv_to_rgb(min(1.0, H * m["H"]), min(1.0, S * m["S"]), min(1.0, V * m["V"]))
-    return ';'.join([str(int(x * 255)) for x in [r, g, b]]) + "m"
+        self.write(chunk)
+        if self.imageList:
+            self.draw_images()
+
+    def draw_images(self, wait = False):
+        # Images go out in the order they came in, after the line they were on, as soon
+        # as they're loaded. Not in the middle of a code block or a table though, those
+        # wait for it to end. With wait, it's the end of the input and whatever's still
+        # loading gets until its deadline.
+        state = self.state
+        if not wait and (state.in_code or state.in_table):
+            return
+        while self.imageList:
+            future, deadline, url = self.imageList[0]
+            if not future.done():
+                left = deadline - time.monotonic()
+                if left > 0 and not wait:
+                    return
+                try:
+                    future.result(timeout = max(0, left))
+                except Exception:
+                    future.cancel()
+            self.imageList.pop(0)
+            image = future.result() if future.done() and not future.cancelled() else None
+            if image:
+                self.write(image)
+            else:
+                logging.debug(f"Couldn't load the image {url}")
+
+    def flush(self):
+        # Lets go of the chunk emit_chunk was holding on to
+        if self.state.table_rows:
+            self.table_flush()
+        if len(self.state.emit_buffer):
+            self.write(self.state.emit_buffer.pop(0))
+        if self.imageList:
+            self.draw_images(wait = True)
+        if isinstance(self.state.Logging, capture.Capture):
+            self.state.Logging.flush()
+        self.save_blocks()
+        if self.stats:
+            self.stats.covered = self.stats.consumed
+
+    def write(self, text):
+        if self.out:
+            self.out.write(text)
+        else:
+            self.output.append(text)
+
+    def collect(self):
+        # The caller is going back to wait for more so anything held back goes out now
+        if self.out:
+            self.out.flush()
+        res = "".join(self.output)
+        self.output = []
+        if self.stats and res:
+            self.stats.flushed(res)
+        return res
+
+    def feed(self, data):
+        # Takes bytes or text, whatever's handy, and hands back what it could render.
+        # Only complete lines get rendered, the rest waits for more.
+        size = len(data)
+        if isinstance(data, bytes):
+            self.debug_write(data)
+            data = self.decoder.decode(data)
+        if self.stats:
+            self.stats.arrived(size, len(data))
+        for line in self.lines(data):
+            self.render(line)
+        return self.collect()
+
+    def idle(self):
+        # Call this when the input has gone quiet for a bit. If the partial line
+        # looks like a prompt it gets shown, this is what a Timeout does in the cli.
+        self.debug_write(None, idle = True)
+        if self.state.table_rows:
+            self.table_flush()
+        if self.imageList:
+            self.draw_images()
+        if self.state.buffer:
+            self.render(self.state.buffer)
+        self.save_blocks()
+        return self.collect()
+
+    def close(self):
+        # Unlike the cli, a last line without a newline still gets rendered
+        self.feed(self.decoder.decode(b'', final=True))
+        if self.state.buffer:
+            self.render(self.lines('\n')[0])
+        self.flush()
+        return self.collect()
+
+    def width_calc(self):
+        state, style = self.state, self.style
+        if state.WidthArg:
+           width = state.WidthArg
+        else:
+           try:
+               width = terminal_width()
+               state.WidthWrap = True
+           except (AttributeError, OSError):
+               # this means it's a pager, we can just ignore the base64 clipboard
+               width = 80
+               pass
+
+        # Our list item stack (and blockquotes) can change the pad as well as the width
+        # so that's what we go by
+        pre = state.space_left(listwidth=True) if style.PrettyBroken else ''
+        key = (width, pre)
+        if state.width_key == key:
+            return
+
+        state.width_key = key
+        state.WidthFull = width
+        state.Width = state.WidthFull - 2 * style.Margin
+
+        if key not in self.codepads:
+            design  = [FG, '▄','▀'] if style.PrettyPad else [BG, ' ',' ']
+            self.codepads[key] = [
+                f"{pre}{RESET}{design[0]}{style.Dark}{design[1] * state.full_width()}{RESET}\n",
+                f"{pre}{RESET}{design[0]}{style.Dark}{design[2] * state.full_width()}{RESET}"
+            ]
+        style.Codepad = self.codepads[key]
+
+async def arender(source, renderer = None):
+    # The asyncio way in. source is an async iterator of bytes or str, in whatever
+    # pieces it likes, and we yield rendered output as soon as a line is done. Lines
+    # get rendered on a worker thread so a big code block doesn't hold up the event
+    # loop, and we go get the next chunk while that happens.
+    import asyncio
+    renderer = renderer or Renderer()
+    loop = asyncio.get_running_loop()
+    source = source.__aiter__()
+    pending = asyncio.ensure_future(source.__anext__())
+    try:
+        while True:
+            done, _ = await asyncio.wait([pending], timeout = renderer.state.Timeout)
+            if not done:
+                # It's gone quiet, the partial line may be a prompt
+                res = renderer.idle()
+                if res:
+                    yield res
+                continue
 
-def width_calc():
-    if state.WidthArg:
-       width = state.WidthArg
+            try:
+                chunk = pending.result()
+            except StopAsyncIteration:
+                break
+            pending = asyncio.ensure_future(source.__anext__())
+
+            # Most chunks are a token or two that don't finish a line and all feed
+            # does then is hold on to them, so there's no point in a thread
+            if (b'\n' if isinstance(chunk, bytes) else '\n') in chunk:
+                res = await loop.run_in_executor(None, renderer.feed, chunk)
+            else:
+                res = renderer.feed(chunk)
+            if res:
+                yield res
+
+        res = await loop.run_in_executor(None, renderer.close)
+        if res:
+            yield res
+    finally:
+        pending.cancel()
+
+async def render_stream(source, writer, renderer = None):
+    # arender into writer, which can be an asyncio.StreamWriter or anything with write
+    import asyncio
+    for_stream = isinstance(writer, asyncio.StreamWriter)
+    async for res in arender(source, renderer):
+        writer.write(res.encode('utf-8') if for_stream else res)
+        if for_stream:
+            await writer.drain()
+        elif hasattr(writer, 'flush'):
+            writer.flush()
+
+def replay(renderer, path, speed = 1):
+    # --replay. Feeds a capture back in with the gaps it had between chunks, divided
+    # by speed, with the timeouts where they were. 0 is as fast as it'll go, which is
+    # the same output, just sooner.
+    start = None
+    for when, kind, data in capture.read(path):
+        if speed:
+            if start is None:
+                start = time.monotonic() - when / speed
+            left = start + when / speed - time.monotonic()
+            if left > 0:
+                time.sleep(left)
+        if kind == capture.IDLE:
+            renderer.idle()
+        else:
+            renderer.feed(data)
+    renderer.flush()
+
+def file_header(fname):
+    return f"\n------\n# {fname}\n\n------\n".encode('utf-8')
+
+def emit_path(renderer, fname, header):
+    # A file argument, with a header in front of it if there's more than one
+    state = renderer.state
+    if header:
+        renderer.emit(BytesIO(file_header(fname)))
+    state.source, state.line_no = fname, 0
+    if state.scrape:
+        # a cached render wouldn't have anything to scrape
+        renderer.emit(open(fname, "rb"))
     else:
-       try:
-           width = shutil.get_terminal_size().columns
-           state.WidthWrap = True
-       except (AttributeError, OSError):
-           # this means it's a pager, we can just ignore the base64 clipboard
-           width = 80
-           pass
-
-
-    # This can't be done because our list item stack can change as well so
-    # unless we want to track that too, we're SOL
-    #if state.WidthFull == width:
-    #    return
-
-    state.WidthFull = width
-
-    state.Width = state.WidthFull - 2 * Style.Margin
-    pre = state.space_left(listwidth=True) if Style.PrettyBroken else ''
-    design  = [FG, '▄','▀'] if Style.PrettyPad else [BG, ' ',' ']
-    Style.Codepad = [
-        f"{pre}{RESET}{design[0]}{Style.Dark}{design[1] * state.full_width()}{RESET}\n",
-        f"{pre}{RESET}{design[0]}{Style.Dark}{design[2] * state.full_width()}{RESET}"
-    ]
+        renderer.emit_file(fname)
+
+def render_path(fname, header, config, base, width, loglevel, scrape):
+    # --jobs. This is a file argument in a worker process. It gets a renderer of its own
+    # and hands back what that rendered after the header, logging included, the blocks
+    # for scrape and savebrace, the last code block for the clipboard and what was
+    # carried into the file and out of it.
+    out = StringIO()
+    renderer = Renderer(config = config, base = base, width = width, out = out)
+    state = renderer.state
+    state.Logging = False
+    if scrape:
+        state.scrape = ScrapeList()
+    # render_paths saves them if it uses this
+    renderer.save_blocks = lambda: None
+    logging.basicConfig(stream=renderer.out, level=loglevel, format=f'%(message)s', force=True)
+    if header:
+        renderer.emit(BytesIO(file_header(fname)))
+        out.seek(0)
+        out.truncate()
+    start = state.carry()
+    emit_path(renderer, fname, False)
+    renderer.collect()
+    return {
+        'start': start, 'end': state.carry(), 'text': out.getvalue(),
+        'code': '' if state.code_buffer_raw.spilled() else str(state.code_buffer_raw),
+        'scrape': state.scrape.blockList if scrape else [], 'save': renderer.saveList,
+    }
+
+def render_paths(renderer, args):
+    # --jobs. The files are rendered in a pool of processes and written out in the order
+    # they were given, each one as soon as the ones before it are done. It comes out the
+    # same as one after the other. The headers are done here, and a file is rendered
+    # again here instead if it didn't start the way it would have here, after a file
+    # that ended in a list for instance, or if it ends in a code block or a table, which
+    # carry on into the next one with more than we get back.
+    from concurrent.futures import ProcessPoolExecutor
+    state = renderer.state
+    fileList = args.filenameList
+    count = len(fileList)
+    pool = ProcessPoolExecutor(max_workers = min(args.jobs, count))
+    try:
+        for fname, res in zip(fileList, pool.map(render_path, fileList, [count > 1] * count, [args.config] * count, [args.base] * count,
+                                                 [int(args.width)] * count, [args.loglevel.upper()] * count, [args.scrape] * count)):
+            if count > 1:
+                renderer.emit(BytesIO(file_header(fname)))
+            if state.carry() != res['start'] or res['end']['in_code'] or res['end']['in_table'] or res['end']['emit_flag']:
+                emit_path(renderer, fname, False)
+                continue
+            state.source, state.line_no = fname, 0
+            renderer.write(res['text'])
+            renderer.collect()
+            for name, value in res['end'].items():
+                setattr(state, name, value)
+            for text, *rest in res['scrape']:
+                state.scrape.add(CodeBuffer(text), *rest)
+            renderer.saveList += res['save']
+            renderer.save_blocks()
+            if res['code']:
+                state.code_buffer_raw = CodeBuffer(res['code'])
+    finally:
+        pool.shutdown(cancel_futures = True)
 
 def main():
     parser = ArgumentParser(
@@ -1102,7 +2496,12 @@ def main():
     parser.add_argument("-w", "--width", default="0", help="Set the width WIDTH")
     parser.add_argument("-e", "--exec", help="Wrap a program EXEC for more 'proper' i/o handling")
     parser.add_argument("-s", "--scrape", help="Scrape code snippets to a directory SCRAPE")
+    parser.add_argument("-j", "--jobs", type=int, default=1, help="Render JOBS file arguments at a time in separate processes")
     parser.add_argument("-v", "--version", action="store_true", help="Show version information")
+    parser.add_argument("--stats", nargs="?", const="-", help="On exit write latency and throughput stats to stderr or a json file STATS")
+    parser.add_argument("--profile", help="On exit write where the rendering time went to a json file PROFILE (- for stderr)")
+    parser.add_argument("--replay", metavar="FILE", help="Play back a capture from the Logging feature with the timing it had")
+    parser.add_argument("--speed", type=float, default=1, help="How many times faster --replay goes, 0 for as fast as it can")
     args = parser.parse_args()
 
     if args.version:
@@ -1119,38 +2518,19 @@ def main():
 
         sys.exit(0)
 
-    config = ensure_config_file(args.config)
-    style = toml.loads(default_toml).get('style') | config.get("style", {})
-    features = toml.loads(default_toml).get('features') | config.get("features", {})
-    H, S, V = style.get("HSV")
-
-    if args.base:
-        env_colors = args.base.split(",")
-        if len(env_colors) > 0: H = float(env_colors[0])
-        if len(env_colors) > 1: S = float(env_colors[1])
-        if len(env_colors) > 2: V = float(env_colors[2])
-
-    for color in ["Dark", "Mid", "Symbol", "Head", "Grey", "Bright"]:
-        setattr(Style, color, apply_multipliers(style, color, H, S, V))
-    for attr in ['PrettyPad', 'PrettyBroken', 'Margin', 'ListIndent', 'Syntax']:
-        setattr(Style, attr, style.get(attr))
-    for attr in ['CodeSpaces', 'Clipboard', 'Logging', 'Timeout', 'Savebrace']:
-        setattr(state, attr, features.get(attr))
-
+    watch_resize()
+    renderer = Renderer(config = args.config, base = args.base, width = int(args.width), out = sys.stdout)
+    state = renderer.state
+    if args.stats:
+        renderer.stats = renderer.out.stats = Stats()
+    if args.profile:
+        Profile().watch(renderer)
 
     if args.scrape:
-        os.makedirs(args.scrape, exist_ok=True)
-        state.scrape = args.scrape
-
-    Style.MarginSpaces = " " * Style.Margin
-    state.WidthArg = int(args.width) or style.get("Width") or 0
-    Style.Blockquote = f"{FG}{Style.Grey}│ "
-    width_calc()
+        state.scrape = Scraper(args.scrape)
 
-    Style.Codebg = f"{BG}{Style.Dark}"
-    Style.Link = f"{FG}{Style.Symbol}{UNDERLINE[0]}"
-
-    logging.basicConfig(stream=sys.stdout, level=args.loglevel.upper(), format=f'%(message)s')
+    # This goes through the frame writer so it lands where it happened in the output
+    logging.basicConfig(stream=renderer.out, level=args.loglevel.upper(), format=f'%(message)s')
     if os.name != 'nt':
         state.exec_master, state.exec_slave = pty.openpty()
     try:
@@ -1163,15 +2543,21 @@ def main():
             # Set stdin to raw mode so we don't need to press enter
             tty.setcbreak(sys.stdin.fileno())
             sys.stdout.write("\x1b[?7h")
-            emit(inp)
+            renderer.emit(inp)
+
+        elif args.replay:
+            state.Logging = False
+            replay(renderer, args.replay, args.speed)
 
         elif args.filenameList:
             # Let's say we only care about logging in streams
             state.Logging = False
-            for fname in args.filenameList:
-                if len(args.filenameList) > 1:
-                    emit(BytesIO(f"\n------\n# {fname}\n\n------\n".encode('utf-8')))
-                emit(open(fname, "rb"))
+            # --stats and --profile are about this process so they don't get the pool
+            if args.jobs > 1 and len(args.filenameList) > 1 and not (args.stats or args.profile):
+                render_paths(renderer, args)
+            else:
+                for fname in args.filenameList:
+                    emit_path(renderer, fname, len(args.filenameList) > 1)
                 
         elif sys.stdin.isatty():
             parser.print_help()
@@ -1180,7 +2566,7 @@ def main():
             # this is a more sophisticated thing that we'll do in the main loop
             state.is_pty = True
             os.set_blocking(inp.fileno(), False) 
-            emit(inp)
+            renderer.emit(inp)
 
     except (OSError, KeyboardInterrupt):
         state.exit = 130
@@ -1191,8 +2577,25 @@ def main():
         logging.warning(f"Exception thrown: {type(ex)} {ex}")
         traceback.print_exc()
 
-    if os.isatty(sys.stdout.fileno()) and state.Clipboard and state.code_buffer_raw:
-        code = state.code_buffer_raw
+    if state.scrape and state.scrape.close():
+        logging.warning(f"Couldn't write {state.scrape.failed} scraped blocks to {args.scrape}")
+
+    try:
+        renderer.collect()
+    except OSError:
+        state.exit = 130
+
+    if isinstance(state.Logging, capture.Capture):
+        state.Logging.close()
+
+    if args.stats:
+        renderer.stats.report(args.stats)
+    if args.profile:
+        renderer.profile.report(args.profile)
+
+    # one too big to keep in memory is too big for a terminal's clipboard too
+    if os.isatty(sys.stdout.fileno()) and state.Clipboard and state.code_buffer_raw and not state.code_buffer_raw.spilled():
+        code = str(state.code_buffer_raw)
         # code needs to be a base64 encoded string before emitting
         code_bytes = code.encode('utf-8')
         base64_bytes = base64.b64encode(code_bytes)
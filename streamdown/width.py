@@ -0,0 +1,56 @@
+# How wide things are on the terminal. Just about every line goes through
+# here a few times so it tries hard to not do any work it doesn't need to.
+import re
+from bisect import bisect_right
+from wcwidth import wcwidth
+
+ANSIESCAPE = r'\033(?:\[[0-9;?]*[a-zA-Z]|][0-9]*;;.*?\\|\\)'
+ANSIESCAPE_RE = re.compile(ANSIESCAPE)
+
+# These are inclusive and need to stay sorted
+CJK_RANGES = [
+    (0x3000, 0x303F),    # CJK Symbols and Punctuation
+    (0x3400, 0x4DBF),    # CJK Unified Ideographs Extension A
+    (0x4E00, 0x9FFF),    # CJK Unified Ideographs
+    (0xF900, 0xFAFF),    # CJK Compatibility Ideographs
+    (0xFF00, 0xFFEF),    # CJK Compatibility Punctuation
+    (0x2F800, 0x2FA1F),  # CJK Compatibility Ideographs Supplement
+]
+CJK_STARTS = [start for start, _ in CJK_RANGES]
+
+class CharTable(dict):
+    # Remembers fn(c) for every character it's asked about
+    def __init__(self, fn):
+        self.fn = fn
+
+    def __missing__(self, c):
+        self[c] = res = self.fn(c)
+        return res
+
+def is_cjk(c):
+    point = ord(c)
+    ix = bisect_right(CJK_STARTS, point) - 1
+    return ix >= 0 and point <= CJK_RANGES[ix][1]
+
+WIDTH = CharTable(wcwidth)
+CJK = CharTable(is_cjk)
+
+def visible(text):
+    if '\x1b' not in text:
+        return text
+    return ANSIESCAPE_RE.sub("", text)
+
+def display_width(text):
+    # Like visible_length but for text that has already been through visible()
+    if text.isascii() and text.isprintable():
+        return len(text)
+    return sum(map(WIDTH.__getitem__, text))
+
+def visible_length(text):
+    # many characters have different widths
+    return display_width(visible(text))
+
+def cjk_count(text):
+    if text.isascii():
+        return 0
+    return sum(map(CJK.__getitem__, visible(text)))
@@ -0,0 +1,986 @@
+#!/usr/bin/env python3
+# Performance checks for sd.py. Most of them print numbers so you can compare
+# before and after a change. These also check something and exit 1 when it's
+# wrong, so they can gate a change: startup, pipes, images, highlight, tables,
+# stream, rendercache, jobs, soak, capture and compare (suite against suite).
+# throughput, reader, codeblock, classify, width, frames, exec and suite only print.
+#
+#   ./bench.py throughput [--mb 4]
+#   ./bench.py reader [--mb 16]
+#   ./bench.py rendercache [--mb 1]
+#   ./bench.py jobs [--notes 200] [--jobs 2,4,8]
+#   ./bench.py codeblock [--lines 250,500,1000,2000]
+#   ./bench.py highlight [--widths 40,80,120] [--lines 2000] [files ...]
+#   ./bench.py classify [files ...]
+#   ./bench.py width [files ...]
+#   ./bench.py stream [--delay 0] [files ...]
+#   ./bench.py frames [--delay 0.002] [files ...]
+#   ./bench.py startup [--budget 60] [--runs 10]
+#   ./bench.py pipes [--delay 2]
+#   ./bench.py images [--delay 1]
+#   ./bench.py tables [--width 100] [--rows 8] [--long 2000] [files ...]
+#   ./bench.py exec [--mb 4] [--keys 50]
+#   ./bench.py soak [--lines 1000] [--times 4] [--spill 32768]
+#   ./bench.py capture [--delay 0.005] [--speed 4] [files ...]
+#   ./bench.py suite [--rounds 3] [--min-time 0.5] [--out results.json] [files ...]
+#   ./bench.py compare old.json new.json [--threshold 10]
+#
+import argparse
+import asyncio
+import io
+import glob
+import http.server
+import json
+import platform
+import os
+import pty
+import random
+import select
+import shutil
+import subprocess
+import sys
+import tempfile
+import threading
+import time
+import tracemalloc
+
+HERE = os.path.dirname(os.path.abspath(__file__))
+sys.path.insert(0, os.path.join(HERE, '..'))
+SD = os.path.join(HERE, '..', 'streamdown', 'sd.py')
+
+def fixtures():
+    # images go out to the network, we don't want that in a timing run
+    return [f for f in sorted(glob.glob(os.path.join(HERE, '*.md')))
+              if '![' not in open(f, encoding='utf-8').read() and not f.endswith('README.md')]
+
+def corpus(mb):
+    body = b''.join(open(f, 'rb').read() for f in fixtures())
+    out = tempfile.NamedTemporaryFile(prefix='sd-bench', suffix='.md', delete=False)
+    out.write(body * max(1, int(mb * 2**20 / len(body))))
+    out.close()
+    return out.name
+
+def run(args, stdin=None):
+    start = time.perf_counter()
+    subprocess.run([sys.executable, SD, '-w', '80'] + args, stdin=stdin,
+                   stdout=subprocess.DEVNULL, stderr=subprocess.DEVNULL, check=True)
+    return time.perf_counter() - start
+
+def throughput(args):
+    path = corpus(args.mb)
+    size = os.path.getsize(path) / 2**20
+    try:
+        ttl = run([path])
+        print(f"file  {size:6.2f}MB {ttl:7.2f}s {size/ttl:7.3f}MB/s")
+        with open(path, 'rb') as f:
+            ttl = run([], stdin=f)
+        print(f"pipe  {size:6.2f}MB {ttl:7.2f}s {size/ttl:7.3f}MB/s")
+    finally:
+        os.unlink(path)
+
+def rendercache(args):
+    # sd on a big file without RenderCache, then with it the first time (a miss, so
+    # what it costs to hash and keep it) and again (a hit). The hit has to come out the
+    # same as the render did. The cache is in a temporary directory.
+    path = corpus(args.mb)
+    size = os.path.getsize(path) / 2**20
+    cache = tempfile.mkdtemp(prefix='sd-bench')
+    env = dict(os.environ, XDG_CACHE_HOME=cache)
+    config = ['-c', '[features]\nRenderCache = 1024']
+    try:
+        resList = []
+        for name, extra in [('off', []), ('miss', config), ('hit', config), ('hit', config)]:
+            start = time.perf_counter()
+            res = subprocess.run([sys.executable, SD, '-w', '80'] + extra + [path], stdin=subprocess.DEVNULL,
+                                 stdout=subprocess.PIPE, stderr=subprocess.DEVNULL, env=env, check=True).stdout
+            ttl = time.perf_counter() - start
+            resList.append(res)
+            print(f"{name:5s} {size:6.2f}MB {ttl:7.3f}s {size/ttl:8.3f}MB/s")
+        if len(set(resList)) != 1:
+            print("the cached output is different")
+            sys.exit(1)
+    finally:
+        os.unlink(path)
+        shutil.rmtree(cache)
+
+def jobs(args):
+    # A directory of --notes made up notes, each a handful of fixtures, through sd one
+    # after the other and then with --jobs. Every --jobs has to come out byte for byte
+    # the same as one after the other, headers between the files and all.
+    tmp = tempfile.mkdtemp(prefix='sd-bench')
+    rnd = random.Random(args.notes)
+    dataList = [open(f, 'rb').read() for f in fixtures()]
+    fileList = []
+    for ix in range(args.notes):
+        path = os.path.join(tmp, f"note{ix:04d}.md")
+        with open(path, 'wb') as f:
+            f.write(b'\n'.join(rnd.sample(dataList, 3)))
+        fileList.append(path)
+    size = sum(os.path.getsize(f) for f in fileList) / 2**20
+    try:
+        resList = []
+        for count in [1] + sorted({int(x) for x in args.jobs.split(',')} - {1}):
+            start = time.perf_counter()
+            res = subprocess.run([sys.executable, SD, '-w', '80', '--jobs', str(count)] + fileList, stdin=subprocess.DEVNULL,
+                                 stdout=subprocess.PIPE, stderr=subprocess.DEVNULL, check=True).stdout
+            ttl = time.perf_counter() - start
+            if count == 1:
+                base, first = ttl, res
+            same = res == first
+            resList.append(same)
+            print(f"jobs {count:3d} {args.notes:5d} files {size:6.2f}MB {ttl:7.2f}s {size/ttl:7.3f}MB/s {base/ttl:5.2f}x "
+                  f"{'ok' if same else 'FAIL: not the same as one after the other'}")
+        if not all(resList):
+            sys.exit(1)
+    finally:
+        shutil.rmtree(tmp)
+
+def codeblock(args):
+    # Per line cost of a fenced block as it gets longer. This should stay flat.
+    src = open(os.path.join(HERE, 'mandlebrot.md'), encoding='utf-8').read()
+    body = src.split('```python\n')[1].split('```')[0].splitlines(True)
+    for count in [int(x) for x in args.lines.split(',')]:
+        lineList = (body * (count // len(body) + 1))[:count]
+        with tempfile.NamedTemporaryFile('w', prefix='sd-bench', suffix='.md', delete=False) as f:
+            f.write('```python\n' + ''.join(lineList) + '```\n')
+        try:
+            ttl = run([f.name])
+        finally:
+            os.unlink(f.name)
+        print(f"{count:6d} lines {ttl:7.2f}s {1000*ttl/count:7.3f}ms/line")
+
+def highlight(args):
+    # Code blocks are lexed from an anchor a ways back instead of from the top every line.
+    # This renders the fixtures that way and again relexing the whole block for every
+    # line, which is how it used to be done, and they have to come out the same.
+    from pygments import highlight
+    from streamdown import sd
+
+    class Whole(sd.Renderer):
+        def code_highlight(self, tline):
+            state = self.state
+            if state.highlighter is not getattr(self, 'highlighter', None):
+                self.highlighter, self.block = state.highlighter, ''
+            this_batch = sd.code_snip(highlight(self.block + tline, state.lexer, state.formatter), tline)
+            self.block += tline
+            return this_batch
+
+    failed = False
+    for path in args.files or fixtures():
+        data = open(path, encoding='utf-8').read()
+        for width in [int(x) for x in args.widths.split(',')]:
+            outList = []
+            for cls in [sd.Renderer, Whole]:
+                renderer = cls(width = width)
+                renderer.state.Savebrace = False
+                start = time.perf_counter()
+                outList.append((renderer.feed(data) + renderer.close(), time.perf_counter() - start))
+            differ = sum(a != b for a, b in zip(outList[0][0].split('\n'), outList[1][0].split('\n')))
+            failed = failed or outList[0][0] != outList[1][0]
+            print(f"{os.path.basename(path):30s} {width:4d} wide {outList[0][1]:6.3f}s against {outList[1][1]:6.3f}s "
+                  f"{'ok' if outList[0][0] == outList[1][0] else f'FAIL: {differ} lines differ'}")
+
+    # A block that lexes to one token the whole way down, plain text or a docstring that
+    # doesn't end. What gets lexed for a line can't keep growing with it, and the text
+    # one has to come out the same as the whole block relexed too.
+    for language, head in [('text', ''), ('python', '"""\n')]:
+        bodyList = [f'2025-01-01 12:00:{ix % 60:02d} INFO worker[{ix % 16}] handled request {ix * 7919}\n' for ix in range(args.lines)]
+        renderer = sd.Renderer(width = 80)
+        renderer.state.Savebrace = False
+        renderer.feed(f"```{language}\n{head}")
+        most = 0
+        start = time.perf_counter()
+        for line in bodyList:
+            renderer.feed(line)
+            most = max(most, len(renderer.state.highlighter.text))
+        ttl = time.perf_counter() - start
+        passed = most <= 2 * sd.Highlighter.Window
+        if language == 'text':
+            data = f"```{language}\n{head}" + ''.join(bodyList[:args.lines // 4]) + "```\n"
+            outList = []
+            for cls in [sd.Renderer, Whole]:
+                renderer = cls(width = 80)
+                renderer.state.Savebrace = False
+                outList.append(renderer.feed(data) + renderer.close())
+            passed = passed and outList[0] == outList[1]
+        failed = failed or not passed
+        print(f"{language + ' block':30s} {args.lines:6d} lines {1000*ttl/args.lines:7.3f}ms/line lexed at most {most:6d} chars {'ok' if passed else 'FAIL'}")
+    sys.exit(1 if failed else 0)
+
+def classify(args):
+    # The block classifier on its own, per line
+    from streamdown import sd
+    for path in args.files or [os.path.join(HERE, x) for x in ['markdown.md', 'example.md']]:
+        lineList = open(path, encoding='utf-8').readlines()
+        rounds = max(1, 200000 // len(lineList))
+        start = time.perf_counter()
+        for _ in range(rounds):
+            for line in lineList:
+                sd.classify(line)
+        ttl = time.perf_counter() - start
+        print(f"{os.path.basename(path):20s} {len(lineList):5d} lines {1e9*ttl/(rounds*len(lineList)):7.0f}ns/line")
+
+def width(args):
+    # The display width helpers over every line of a file, per line
+    from streamdown import sd
+    for path in args.files or [os.path.join(HERE, x) for x in ['cjk-table.md', 'cjk-wrap.md']]:
+        lineList = open(path, encoding='utf-8').readlines()
+        rounds = max(1, 100000 // len(lineList))
+        for fn in [sd.visible_length, sd.cjk_count, sd.split_text]:
+            start = time.perf_counter()
+            for _ in range(rounds):
+                for line in lineList:
+                    fn(line)
+            ttl = time.perf_counter() - start
+            print(f"{os.path.basename(path):20s} {fn.__name__:15s} {1e9*ttl/(rounds*len(lineList)):7.0f}ns/line")
+
+def reader(args):
+    # Just the line assembly, no rendering
+    from streamdown import sd
+    path = corpus(args.mb)
+    data = open(path, 'rb').read()
+    os.unlink(path)
+    renderer = sd.Renderer(width = 80)
+    renderer.state.Logging = False
+    start = time.perf_counter()
+    count = sum(1 for _ in renderer.readlines(io.BytesIO(data)))
+    ttl = time.perf_counter() - start
+    print(f"reader {len(data)/2**20:6.2f}MB {count} lines {ttl:7.2f}s {len(data)/2**20/ttl:7.3f}MB/s")
+
+def stream(args):
+    # Feeds fixtures through arender from a fake llm that hands out a few bytes
+    # at a time. Checks the output matches feeding it all at once and reports how
+    # long the event loop was ever kept waiting.
+    from streamdown import sd
+
+    async def tokens(data):
+        rnd = random.Random(len(data))
+        ix = 0
+        while ix < len(data):
+            size = rnd.randint(1, 12)
+            yield data[ix:ix + size]
+            ix += size
+            await asyncio.sleep(args.delay)
+
+    async def ticker(lagList):
+        while True:
+            start = time.perf_counter()
+            await asyncio.sleep(0.001)
+            lagList.append(time.perf_counter() - start - 0.001)
+
+    async def one(path):
+        data = open(path, 'rb').read()
+        want = sd.Renderer(width = 80)
+        want = want.feed(data) + want.close()
+
+        lagList = []
+        tick = asyncio.ensure_future(ticker(lagList))
+        out = []
+        start = time.perf_counter()
+        first = None
+        async for res in sd.arender(tokens(data), sd.Renderer(width = 80)):
+            first = first or time.perf_counter() - start
+            out.append(res)
+        ttl = time.perf_counter() - start
+        tick.cancel()
+        status = 'ok' if ''.join(out) == want else 'MISMATCH'
+        print(f"{os.path.basename(path):30s} {status:8s} first {1000*(first or 0):7.1f}ms total {ttl:6.2f}s max loop stall {1000*max(lagList or [0]):6.1f}ms")
+        return status == 'ok'
+
+    async def every():
+        return [await one(path) for path in args.files or fixtures()]
+
+    if not all(asyncio.run(every())):
+        sys.exit(1)
+
+class Counter(io.RawIOBase):
+    # Stands in for the terminal, every write here would have been a syscall
+    def __init__(self):
+        self.calls = self.size = 0
+
+    def writable(self):
+        return True
+
+    def write(self, b):
+        self.calls += 1
+        self.size += len(b)
+        return len(b)
+
+def frames(args):
+    # Replays fixtures into the piped reader like chunk-buffer.sh does: split on the
+    # 🫣 timeout markers if there are any, otherwise in 1-12 byte tokens, with a
+    # sleep after each. Output goes to a line buffered stream like a terminal's.
+    from streamdown import sd
+    for path in args.files or fixtures():
+        data = open(path, 'rb').read()
+        rnd = random.Random(len(data))
+        pieceList = []
+        if '🫣'.encode('utf-8') in data:
+            pieceList = data.split('🫣'.encode('utf-8'))
+        else:
+            ix = 0
+            while ix < len(data):
+                size = rnd.randint(1, 12)
+                pieceList.append(data[ix:ix + size])
+                ix += size
+
+        for name, interval in [('per chunk', 0), ('frames', 0.016)]:
+            counter = Counter()
+            out = io.TextIOWrapper(io.BufferedWriter(counter), encoding='utf-8', line_buffering=True)
+            renderer = sd.Renderer(width = 80, out = sd.FrameWriter(out, interval, sync = interval > 0))
+            renderer.state.Logging = False
+            renderer.state.is_pty = True
+            renderer.state.exec_master, quiet = os.pipe()
+            read_end, write_end = os.pipe()
+
+            def feed():
+                for piece in pieceList:
+                    os.write(write_end, piece)
+                    time.sleep(args.delay)
+                os.close(write_end)
+
+            writer = threading.Thread(target=feed)
+            start = time.perf_counter()
+            writer.start()
+            with os.fdopen(read_end, 'rb', buffering=0) as stream:
+                renderer.emit(stream)
+            ttl = time.perf_counter() - start
+            writer.join()
+            os.close(renderer.state.exec_master)
+            os.close(quiet)
+            print(f"{os.path.basename(path):30s} {name:10s} {len(pieceList):6d} reads {counter.calls:6d} writes {counter.size:8d} bytes {ttl:6.2f}s {counter.size/ttl/1024:8.1f}KB/s")
+
+def percentile(sortedList, pct):
+    if not sortedList:
+        return 0
+    return sortedList[min(len(sortedList) - 1, int(len(sortedList) * pct / 100))]
+
+def pieces(data, mode):
+    # How the input gets handed to feed in each mode
+    if mode == 'whole':
+        return [data]
+    if mode == 'lines':
+        return data.splitlines(True)
+    # the recorded timeouts from the Logging feature, without the sleeping
+    return data.split('🫣'.encode('utf-8'))
+
+def suite(args):
+    # Everything through the Renderer in process, so no terminal and no subprocess
+    # noise. Each fixture is done whole, line by line and in its recorded 🫣 chunks.
+    from streamdown import sd
+
+    class TimedRenderer(sd.Renderer):
+        def render(self, line):
+            start = time.perf_counter()
+            super().render(line)
+            self.timeList.append(time.perf_counter() - start)
+
+    def once(pieceList, traced = False):
+        renderer = TimedRenderer(width = 80)
+        renderer.state.Savebrace = renderer.state.Logging = False
+        renderer.timeList = []
+        if traced:
+            tracemalloc.start()
+        start = time.perf_counter()
+        for piece in pieceList:
+            renderer.feed(piece)
+        renderer.close()
+        ttl = time.perf_counter() - start
+        peak = 0
+        if traced:
+            peak = tracemalloc.get_traced_memory()[1]
+            tracemalloc.stop()
+        return ttl, renderer.timeList, peak
+
+    # The first run pays for imports and the lexer caches
+    once([b'```python\nx = 1\n```\n'])
+
+    resultList = []
+    for path in args.files or fixtures():
+        data = open(path, 'rb').read()
+        for mode in ['whole', 'lines', 'chunks']:
+            pieceList = pieces(data, mode)
+            # Small fixtures are over in a few ms so we keep going for a while and take
+            # the best, which is the one that got interrupted the least
+            runList = []
+            start = time.perf_counter()
+            while len(runList) < args.rounds or time.perf_counter() - start < args.min_time:
+                runList.append(once(pieceList)[:2])
+            ttl, timeList = min(runList)
+            peak = once(pieceList, traced = True)[2]
+            timeList.sort()
+            res = {
+                'fixture': os.path.basename(path), 'mode': mode, 'bytes': len(data),
+                'pieces': len(pieceList), 'lines': len(timeList), 'seconds': ttl,
+                'mb_per_s': len(data) / 2**20 / ttl,
+                'p50_us': 1e6 * percentile(timeList, 50), 'p90_us': 1e6 * percentile(timeList, 90),
+                'p99_us': 1e6 * percentile(timeList, 99), 'max_us': 1e6 * (timeList[-1] if timeList else 0),
+                'peak_kb': peak / 1024,
+            }
+            resultList.append(res)
+            print(f"{res['fixture']:30s} {mode:6s} {res['pieces']:5d} pieces {res['mb_per_s']:7.3f}MB/s "
+                  f"p50 {res['p50_us']:7.0f}us p90 {res['p90_us']:7.0f}us p99 {res['p99_us']:7.0f}us "
+                  f"max {res['max_us']:7.0f}us peak {res['peak_kb']:7.0f}KB")
+
+    if args.out:
+        rev = subprocess.run(['git', 'describe', '--always', '--dirty'], cwd=HERE,
+                             stdout=subprocess.PIPE, stderr=subprocess.DEVNULL, text=True).stdout.strip()
+        meta = {'python': platform.python_version(), 'platform': platform.platform(),
+                'revision': rev, 'time': time.strftime('%Y-%m-%dT%H:%M:%S'), 'rounds': args.rounds, 'min_time': args.min_time}
+        with open(args.out, 'w') as f:
+            json.dump({'meta': meta, 'results': resultList}, f, indent=1)
+
+def compare(args):
+    # Lines up two suite results. Exits 1 if anything got slower by more than threshold percent
+    old, new = [json.load(open(x)) for x in [args.old, args.new]]
+    print(f"old {old['meta']['revision']} {old['meta']['time']}  new {new['meta']['revision']} {new['meta']['time']}")
+    oldMap = {(r['fixture'], r['mode']): r for r in old['results']}
+    worse = 0
+    for res in new['results']:
+        was = oldMap.get((res['fixture'], res['mode']))
+        if not was:
+            continue
+        change = 100 * (was['seconds'] - res['seconds']) / res['seconds']
+        p99 = 100 * (was['p99_us'] - res['p99_us']) / max(res['p99_us'], 1)
+        peak = res['peak_kb'] - was['peak_kb']
+        flag = ''
+        if change < -args.threshold:
+            flag = '  <-- slower'
+            worse += 1
+        print(f"{res['fixture']:30s} {res['mode']:6s} {was['mb_per_s']:7.3f} -> {res['mb_per_s']:7.3f}MB/s {change:+6.1f}% "
+              f"p99 {p99:+6.1f}% peak {peak:+7.0f}KB{flag}")
+    if worse:
+        sys.exit(1)
+
+# These shouldn't get imported for plain text
+HEAVY = ['pygments', 'term_image', 'PIL', 'pylatexenc', 'asyncio', 'requests']
+
+def startup(args):
+    # How long until the first byte for a one line answer, over and above python
+    # starting up at all. This one is pass/fail, it exits 1 if it's over budget or
+    # if something heavy got imported that didn't need to be.
+    #
+    # It's run the way the installed sd is, from the package with its bytecode
+    # cached. Running sd.py as a script compiles all of it every time and that says
+    # more about the size of the file than anything it does.
+    env = dict(os.environ, PYTHONPATH=os.path.join(HERE, '..'))
+    env.pop('PYTHONDONTWRITEBYTECODE', None)
+    entry = [sys.executable, '-c', 'import sys; from streamdown.sd import main; sys.exit(main())', '-w', '80']
+
+    def first_byte(cmd):
+        start = time.perf_counter()
+        proc = subprocess.Popen(cmd, stdin=subprocess.PIPE, stdout=subprocess.PIPE, stderr=subprocess.DEVNULL, env=env)
+        proc.stdin.write(b'hello\n')
+        proc.stdin.close()
+        proc.stdout.read(1)
+        ttl = time.perf_counter() - start
+        proc.stdout.read()
+        proc.wait()
+        return ttl
+
+    # the fastest run is the one with the least noise from whatever else is going on
+    # the first run writes the bytecode if a fresh checkout doesn't have it yet
+    first_byte(entry)
+    bare = min(first_byte([sys.executable, '-c', 'print(1)']) for _ in range(args.runs))
+    sd = min(first_byte(entry) for _ in range(args.runs))
+
+    proc = subprocess.run([sys.executable, '-X', 'importtime'] + entry[1:], input=b'hello\n',
+                          stdout=subprocess.DEVNULL, stderr=subprocess.PIPE, env=env)
+    importList = []
+    loaded = []
+    for line in proc.stderr.decode('utf-8', 'replace').splitlines():
+        if line.startswith('import time:') and '|' in line and 'self [us]' not in line:
+            _, cumulative, name = line.split('|')
+            loaded.append(name.strip())
+            if not name[1:].startswith(' '):
+                importList.append((int(cumulative), name.strip()))
+    heavy = [m for m in HEAVY if any(name == m or name.startswith(m + '.') for name in loaded)]
+
+    print(f"python alone     {1000*bare:7.1f}ms")
+    print(f"sd first byte    {1000*sd:7.1f}ms")
+    print(f"sd overhead      {1000*(sd - bare):7.1f}ms (budget {args.budget}ms)")
+    print(f"slowest imports  " + ", ".join(f"{name} {us/1000:.1f}ms" for us, name in sorted(importList)[-5:][::-1]))
+    print(f"heavy imports    {', '.join(heavy) or 'none'}")
+    if heavy or 1000 * (sd - bare) > args.budget:
+        sys.exit(1)
+
+def pipes(args):
+    # The first paragraph, then the writer goes quiet for --delay seconds before the
+    # rest. The paragraph has to be on the screen before the rest is written, whether
+    # sd gets it as piped stdin, as a fifo file argument or as /dev/stdin. Pass/fail.
+    first, rest = b'# Pipes\n\nthe first paragraph\n\n', b'and the rest of it\n'
+    fifo = os.path.join(tempfile.mkdtemp(prefix='sd-bench'), 'fifo')
+    os.mkfifo(fifo)
+    ok = True
+
+    for name, argList in [('stdin', []), ('fifo', [fifo]), ('/dev/stdin', ['/dev/stdin'])]:
+        start = time.perf_counter()
+        proc = subprocess.Popen([sys.executable, SD, '-w', '80'] + argList, stdin=subprocess.PIPE,
+                                stdout=subprocess.PIPE, stderr=subprocess.DEVNULL)
+        sink = open(fifo, 'wb') if name == 'fifo' else proc.stdin
+        sink.write(first)
+        sink.flush()
+
+        seen = []
+        def watch():
+            output = b''
+            while b'first paragraph' not in output:
+                piece = os.read(proc.stdout.fileno(), 4096)
+                if not piece:
+                    return
+                output += piece
+            seen.append(time.perf_counter() - start)
+        watcher = threading.Thread(target=watch)
+        watcher.start()
+
+        time.sleep(args.delay)
+        resumed = time.perf_counter() - start
+        sink.write(rest)
+        sink.close()
+        if name == 'fifo':
+            proc.stdin.close()
+        watcher.join()
+        proc.stdout.read()
+        proc.wait()
+
+        passed = bool(seen) and seen[0] < resumed
+        ok = ok and passed
+        shown = f"{1000*seen[0]:7.1f}ms" if seen else '  never'
+        print(f"{name:10s} {'ok' if passed else 'FAIL':5s} first paragraph at {shown}, the rest written at {1000*resumed:7.1f}ms")
+
+    if not ok:
+        sys.exit(1)
+
+def images(args):
+    # Serves pvgo_512.jpg from here, --delay seconds late, and checks the text after
+    # the image comes straight out instead of waiting on it. Then again, where it
+    # should come out of the image cache without asking the server, and once more
+    # uncached with an ImageTimeout shorter than the delay to see it gets given up
+    # on. Pass/fail. The image cache is in a temporary directory.
+    os.environ['XDG_CACHE_HOME'] = tempfile.mkdtemp(prefix='sd-bench')
+    from streamdown import sd
+    image = open(os.path.join(HERE, 'pvgo_512.jpg'), 'rb').read()
+    requests = []
+
+    class Slow(http.server.BaseHTTPRequestHandler):
+        def do_GET(self):
+            requests.append(self.path)
+            time.sleep(args.delay)
+            self.send_response(200)
+            self.send_header('Content-Type', 'image/jpeg')
+            self.send_header('Content-Length', str(len(image)))
+            self.end_headers()
+            self.wfile.write(image)
+
+        def log_message(self, *args):
+            pass
+
+    server = http.server.ThreadingHTTPServer(('127.0.0.1', 0), Slow)
+    threading.Thread(target=server.serve_forever, daemon=True).start()
+    url = f"http://127.0.0.1:{server.server_address[1]}/pvgo_512.jpg"
+    ok = True
+
+    for name, timeout, cache in [('loads', args.delay * 4, 64), ('cached', args.delay * 4, 64), ('times out', args.delay / 2, 0)]:
+        renderer = sd.Renderer(width = 80)
+        renderer.state.ImageTimeout = timeout
+        renderer.state.ImageCache = cache
+        asked = len(requests)
+        start = time.perf_counter()
+        text = renderer.feed(f"# Before\n\n![pvgo]({url})\n\nThe text after it\n\nand more\n")
+        text_at = time.perf_counter() - start
+        rest = renderer.close()
+        done_at = time.perf_counter() - start
+        drawn = rest.count('\n') >= 20
+
+        passed = 'The text after it' in text and text_at < args.delay / 2 and drawn == (name != 'times out')
+        if name == 'cached':
+            passed = passed and done_at < args.delay / 2 and len(requests) == asked
+        if name == 'times out':
+            passed = passed and done_at < timeout + args.delay / 4
+        ok = ok and passed
+        print(f"{name:10s} {'ok' if passed else 'FAIL':5s} text after {1000*text_at:7.1f}ms  done {1000*done_at:7.1f}ms  image {'drawn' if drawn else 'not drawn'}")
+
+    # The input goes quiet right after the image. It has to be drawn once it loads, not
+    # when the next line or the end comes, both from idle() and through sd on a pipe.
+    # Each asks for its own url so none of them come out of the image cache.
+    renderer = sd.Renderer(width = 80)
+    start = time.perf_counter()
+    text = renderer.feed(f"# Quiet\n\n![pvgo]({url}?idle)\n\n")
+    while text.count('\n') < 20 and time.perf_counter() - start < args.delay * 4:
+        time.sleep(renderer.state.Timeout)
+        text += renderer.idle()
+    drawn_at = time.perf_counter() - start
+    renderer.close()
+    passed = text.count('\n') >= 20
+    ok = ok and passed
+    print(f"{'idle':10s} {'ok' if passed else 'FAIL':5s} image drawn at {1000*drawn_at:7.1f}ms with nothing after it")
+
+    for name, argList in [('pipe', []), ('fifo', [os.path.join(tempfile.mkdtemp(prefix='sd-bench'), 'fifo')])]:
+        start = time.perf_counter()
+        if argList:
+            os.mkfifo(argList[0])
+        proc = subprocess.Popen([sys.executable, SD, '-w', '80'] + argList, stdin=subprocess.PIPE,
+                                stdout=subprocess.PIPE, stderr=subprocess.DEVNULL)
+        sink = open(argList[0], 'wb') if argList else proc.stdin
+        sink.write(f"# Quiet\n\n![pvgo]({url}?{name})\n\n".encode())
+        sink.flush()
+        output = b''
+        while output.count(b'\n') < 20 and time.perf_counter() - start < args.delay * 4:
+            if select.select([proc.stdout], [], [], args.delay * 4)[0]:
+                output += os.read(proc.stdout.fileno(), 65536)
+        drawn_at = time.perf_counter() - start
+        sink.close()
+        proc.stdin.close()
+        proc.stdout.read()
+        proc.wait()
+        passed = output.count(b'\n') >= 20
+        ok = ok and passed
+        print(f"{name:10s} {'ok' if passed else 'FAIL':5s} image drawn at {1000*drawn_at:7.1f}ms with the writer still there")
+
+    server.shutdown()
+    if not ok:
+        sys.exit(1)
+
+def tables(args):
+    # The table fixtures laid out the old way, every column getting an even share,
+    # and with the column widths worked out from what's in them, with and without
+    # holding rows back to look at first. Prints the time per row, how many lines
+    # it came out as and how many cells got cut short with a …. Then a long made up
+    # table at two lengths to see that the memory doesn't go up with it.
+    from streamdown import sd
+
+    class Even(sd.Renderer):
+        def table_row(self, cells):
+            return self.format_table(cells)
+
+    class EvenHeld(sd.Renderer):
+        # rows are held back like usual but laid out like Even
+        def table_layout(self, natural):
+            available = self.state.current_width() - len(natural) * 2
+            return [available // len(natural) + (1 if ix < available % len(natural) else 0) for ix in range(len(natural))]
+
+    def once(cls, data, rows):
+        renderer = cls(width = args.width)
+        renderer.state.TableRows = rows
+        renderer.state.TableWait = float('inf')
+        start = time.perf_counter()
+        out = renderer.feed(data) + renderer.close()
+        return time.perf_counter() - start, out
+
+    for path in args.files or [os.path.join(HERE, 'table_test.md'), os.path.join(HERE, 'cjk-table.md')]:
+        data = open(path, encoding='utf-8').read()
+        rows = sum(1 for line in data.splitlines() if line.lstrip().startswith('|'))
+        for name, cls, lookahead in [('even', Even, 0), ('lookahead 0', sd.Renderer, 0), (f'lookahead {args.rows}', sd.Renderer, args.rows)]:
+            ttl = min(once(cls, data, lookahead)[0] for _ in range(5))
+            out = once(cls, data, lookahead)[1]
+            print(f"{os.path.basename(path):20s} {name:14s} {1000*ttl/rows:7.3f}ms/row {out.count(chr(10)):6d} lines {out.count('…'):5d} cut")
+
+    # Holding rows back can only change the widths. With those the same it has to come
+    # out the same as rows going straight out, blockquotes around them and all
+    failed = False
+    for path in [os.path.join(HERE, name) for name in ['table-blockquote.md', 'block.md', 'table_test.md']]:
+        data = open(path, encoding='utf-8').read()
+        same = once(Even, data, 0)[1] == once(EvenHeld, data, args.rows)[1]
+        failed = failed or not same
+        print(f"{os.path.basename(path):20s} {'held back':14s} {'ok' if same else 'FAIL: not the same as rows going straight out'}")
+
+    # Tables too narrow for their columns have to still come out, and what's after them too
+    for data in ["| | | | | | |\n|-|-|-|-|-|-|\n| | | | | | |\n\nafter\n",
+                 "| a | b | c | d | e | f |\n|-|-|-|-|-|-|\n| one | two | three | four | five | six |\n\nafter\n"]:
+        for width in [14, 8, 4]:
+            for rows in [0, args.rows]:
+                renderer = sd.Renderer(width = width)
+                renderer.state.TableRows = rows
+                try:
+                    same = 'after' in renderer.feed(data) + renderer.close()
+                except Exception as ex:
+                    same = False
+                    print(f"  {type(ex).__name__}: {ex}")
+                failed = failed or not same
+                print(f"{data.splitlines()[0]:28s} {width:3d} wide {rows} held {'ok' if same else 'FAIL: the rest of it is gone'}")
+
+    for length in [args.long, args.long * 10]:
+        renderer = sd.Renderer(width = args.width)
+        renderer.state.TableRows = args.rows
+        renderer.state.TableWait = float('inf')
+        held = 0
+        tracemalloc.start()
+        renderer.feed("| id | name | description |\n|---|---|---|\n")
+        start = time.perf_counter()
+        for ix in range(length):
+            renderer.feed(f"| {ix} | row {ix} | {'lorem ipsum ' * (ix % 7)}|\n")
+            held = max(held, len(renderer.state.table_rows))
+        ttl = time.perf_counter() - start
+        renderer.close()
+        peak = tracemalloc.get_traced_memory()[1]
+        tracemalloc.stop()
+        print(f"{'long table':20s} {length:8d} rows {1000*ttl/length:7.3f}ms/row peak {peak/1024:8.1f}KB most held {held}")
+
+    if failed:
+        sys.exit(1)
+
+EXEC_CHILD = """
+import sys
+data = open(sys.argv[1], encoding='utf-8').read()
+sys.stdout.write(data)
+sys.stdout.write('BENCH-DONE\\n\\n')
+sys.stdout.flush()
+while sys.stdin.readline().strip() != 'quit':
+    pass
+"""
+
+def exec_(args):
+    # Runs sd --exec on a little program that dumps --mb of the fixtures and then
+    # reads lines until it gets quit, all inside a pty like a terminal would be.
+    # Reports how fast the dump went through, then how long a key takes to come back
+    # (the program's terminal echoes it, through sd) one at a time and as a paste.
+    path = corpus(args.mb)
+    size = os.path.getsize(path) / 2**20
+    child = os.path.join(tempfile.mkdtemp(prefix='sd-bench'), 'child.py')
+    with open(child, 'w') as f:
+        f.write(EXEC_CHILD)
+
+    start = time.perf_counter()
+    pid, fd = pty.fork()
+    if pid == 0:
+        os.execv(sys.executable, [sys.executable, SD, '-w', '80', '-e', f"{sys.executable} {child} {path}"])
+
+    def read_until(marker, timeout = 60):
+        tail = b''
+        end = time.perf_counter() + timeout
+        while marker not in tail:
+            ready, _, _ = select.select([fd], [], [], max(0, end - time.perf_counter()))
+            if not ready:
+                raise TimeoutError(marker)
+            tail = (tail + os.read(fd, 2 ** 16))[-4096:]
+        return time.perf_counter()
+
+    def drain():
+        # so what's left of the dump isn't taken for an echo
+        while select.select([fd], [], [], 0.5)[0]:
+            os.read(fd, 2 ** 16)
+
+    done = read_until(b'BENCH-DONE')
+    ttl = done - start
+    print(f"dump      {size:6.2f}MB {ttl:7.2f}s {size/ttl:7.3f}MB/s")
+    drain()
+
+    latencyList = []
+    for ix in range(args.keys):
+        key = b'abcdefghijklmnopqrstuvwxyz'[ix % 26:ix % 26 + 1]
+        sent = time.perf_counter()
+        os.write(fd, key)
+        latencyList.append(read_until(key, 5) - sent)
+    latencyList.sort()
+    drain()
+    print(f"key echo  p50 {1000*percentile(latencyList, 50):6.2f}ms  p99 {1000*percentile(latencyList, 99):6.2f}ms  max {1000*latencyList[-1]:6.2f}ms ({args.keys} keys)")
+
+    paste = b'xy' * 400 + b'z'
+    sent = time.perf_counter()
+    os.write(fd, b'\n' + paste)
+    echoed = read_until(b'xyz', 10)
+    print(f"paste     {len(paste)} bytes echoed in {1000*(echoed - sent):6.2f}ms")
+
+    os.write(fd, b'\nquit\n')
+    try:
+        read_until(b'never', 5)
+    except (OSError, TimeoutError):
+        pass
+    os.waitpid(pid, 0)
+    os.close(fd)
+
+SOAK_CHILD = """
+import io, os, sys, time, tracemalloc
+sys.path.insert(0, sys.argv[1])
+from streamdown import sd
+kind, count = sys.argv[2], int(sys.argv[3])
+sd.CodeBuffer.Spill = int(sys.argv[4])
+
+class Null(io.TextIOBase):
+    def write(self, text):
+        return len(text)
+
+renderer = sd.Renderer(width = 80, out = Null())
+renderer.state.Savebrace = renderer.state.Logging = False
+renderer.feed(f"```{kind}\\nx = 1\\n```\\n")
+tracemalloc.start()
+start = time.perf_counter()
+renderer.feed(f"```{kind}\\n")
+for ix in range(count):
+    if kind == 'javascript':
+        line = 'var a=function(b){return b+1};' * 128
+    elif kind == 'python':
+        line = f'    result_{ix} = compute(value_{ix}, "label {ix}", {ix % 97})  # note'
+    else:
+        line = f'2025-01-01 12:00:{ix % 60:02d} INFO worker[{ix % 16}] handled request {ix * 7919} in {ix % 97}ms'
+    renderer.feed(line + '\\n')
+renderer.feed("```\\n")
+renderer.close()
+print(time.perf_counter() - start, tracemalloc.get_traced_memory()[1], len(renderer.state.code_buffer_raw))
+"""
+
+def soak(args):
+    # Really long code blocks, each in a process of its own: python (which gets lexed a
+    # bit at a time), text (which is one token the whole way down) and minified
+    # javascript, 4KB lines of it. The raw text goes to disk after --spill bytes instead
+    # of the usual megabyte so that happens without taking all day. Each is done at
+    # --lines and --times as many, and the
+    # peak memory (from tracemalloc, so it's slower than it would be) can't go up by more
+    # than --slack MB for the bigger one or it exits 1. It also prints the time per line,
+    # which should stay about the same.
+    failed = False
+    for kind, count in [('python', args.lines), ('text', args.lines), ('javascript', max(1, args.lines // 100))]:
+        resList = []
+        for size in [count, count * args.times]:
+            res = subprocess.run([sys.executable, '-c', SOAK_CHILD, os.path.join(HERE, '..'), kind, str(size), str(args.spill)],
+                                 stdin=subprocess.DEVNULL, stdout=subprocess.PIPE, check=True, text=True).stdout.split()
+            ttl, grew, raw = float(res[0]), int(res[1]) / 2**20, int(res[2])
+            resList.append(grew)
+            print(f"{kind:10s} {size:7d} lines {raw / 2**20:6.2f}MB {1e3 * ttl / size:7.3f}ms/line peak {grew:6.2f}MB")
+        if resList[1] - resList[0] > args.slack:
+            print(f"  {kind}: that's {resList[1] - resList[0]:.1f}MB more for {args.times} times the lines")
+            failed = True
+    sys.exit(1 if failed else 0)
+
+def capture(args):
+    # What Logging costs and whether --replay gives back what happened. Each fixture
+    # is fed in its recorded chunks (or by line) with and without a capture going, then
+    # a capture made with a --delay between chunks is played back as fast as it goes
+    # and at --speed. Both have to come out the same as the feed did, and the paced one
+    # has to take about as long as it should. Exits 1 if not.
+    from streamdown import sd, capture
+    tmp = tempfile.mkdtemp()
+    failed = False
+
+    def once(pieceList, path = None, delay = 0):
+        renderer = sd.Renderer(width = 80)
+        renderer.state.Savebrace = False
+        renderer.state.Logging = capture.Capture(path) if path else False
+        start = time.perf_counter()
+        res = []
+        for piece in pieceList:
+            res.append(renderer.feed(piece))
+            if delay:
+                time.sleep(delay)
+        res.append(renderer.close())
+        ttl = time.perf_counter() - start
+        if path:
+            renderer.state.Logging.close()
+        return ttl, ''.join(res)
+
+    once([b'```python\nx = 1\n```\n'])
+    for path in args.files or fixtures():
+        data = open(path, 'rb').read()
+        pieceList = pieces(data, 'chunks' if '🫣'.encode('utf-8') in data else 'lines')
+        cap = os.path.join(tmp, 'capture.sdcap')
+        plain = min(once(pieceList)[0] for _ in range(args.rounds))
+        logged = min(once(pieceList, cap)[0] for _ in range(args.rounds))
+
+        expected = once(pieceList, cap, args.delay)[1]
+        ttl = max(when for when, _, _ in capture.read(cap))
+        timeList = []
+        for speed in [0, args.speed]:
+            out = io.StringIO()
+            renderer = sd.Renderer(width = 80, out = sd.FrameWriter(out, 0, sync = False))
+            renderer.state.Savebrace = renderer.state.Logging = False
+            start = time.perf_counter()
+            sd.replay(renderer, cap, speed)
+            timeList.append(time.perf_counter() - start)
+            renderer.close()
+            if out.getvalue() != expected:
+                print(f"  {os.path.basename(path)}: the replay at speed {speed} came out different")
+                failed = True
+
+        # it can be late (the renderer's slower than the delay) but it shouldn't be early
+        if timeList[1] < ttl / args.speed * 0.9:
+            print(f"  {os.path.basename(path)}: the replay at {args.speed}x took {timeList[1]:.2f}s, that's too quick for {ttl:.2f}s")
+            failed = True
+        print(f"{os.path.basename(path):30s} {len(pieceList):5d} chunks {len(data) / 2**20 / plain:7.3f}MB/s "
+              f"logged {len(data) / 2**20 / logged:7.3f}MB/s ({100 * (logged - plain) / plain:+5.1f}%) "
+              f"recorded {ttl:5.2f}s replayed {timeList[1]:5.2f}s at {args.speed:g}x, {timeList[0]:5.3f}s flat out")
+    shutil.rmtree(tmp)
+    sys.exit(1 if failed else 0)
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser()
+    sub = parser.add_subparsers(dest='cmd', required=True)
+    p = sub.add_parser('throughput', help='MB/s of tests/*.md through sd')
+    p.add_argument('--mb', type=float, default=4)
+    p.set_defaults(fn=throughput)
+    p = sub.add_parser('rendercache', help='a big file argument without RenderCache, missing it and hitting it')
+    p.add_argument('--mb', type=float, default=1)
+    p.set_defaults(fn=rendercache)
+    p = sub.add_parser('jobs', help='a directory of notes one after the other and with --jobs')
+    p.add_argument('--notes', type=int, default=200)
+    p.add_argument('--jobs', default=f"2,4,{os.cpu_count()}", help='the --jobs to try, comma separated')
+    p.set_defaults(fn=jobs)
+    p = sub.add_parser('codeblock', help='per line cost against code block length')
+    p.add_argument('--lines', default='250,500,1000,2000')
+    p.set_defaults(fn=codeblock)
+    p = sub.add_parser('highlight', help='code blocks lexed from an anchor against relexing the whole block')
+    p.add_argument('--widths', default='40,80,120')
+    p.add_argument('--lines', type=int, default=2000, help='lines in the made up one token blocks')
+    p.add_argument('files', nargs='*')
+    p.set_defaults(fn=highlight)
+    p = sub.add_parser('classify', help='per line cost of the block classifier')
+    p.add_argument('files', nargs='*')
+    p.set_defaults(fn=classify)
+    p = sub.add_parser('width', help='per line cost of the display width helpers')
+    p.add_argument('files', nargs='*')
+    p.set_defaults(fn=width)
+    p = sub.add_parser('reader', help='MB/s of the input line reader alone')
+    p.add_argument('--mb', type=float, default=16)
+    p.set_defaults(fn=reader)
+    p = sub.add_parser('stream', help='fixtures through the asyncio api from a fake token stream')
+    p.add_argument('--delay', type=float, default=0)
+    p.add_argument('files', nargs='*')
+    p.set_defaults(fn=stream)
+    p = sub.add_parser('frames', help='write syscalls with and without frame coalescing on a paced replay')
+    p.add_argument('--delay', type=float, default=0.002)
+    p.add_argument('files', nargs='*')
+    p.set_defaults(fn=frames)
+    p = sub.add_parser('startup', help='time to first byte for a one line input, against a budget')
+    p.add_argument('--budget', type=float, default=60, help='ms over bare python startup')
+    p.add_argument('--runs', type=int, default=10)
+    p.set_defaults(fn=startup)
+    p = sub.add_parser('pipes', help='a slow pipe or fifo streams instead of waiting for the end')
+    p.add_argument('--delay', type=float, default=2, help='seconds the writer goes quiet for')
+    p.set_defaults(fn=pipes)
+    p = sub.add_parser('images', help='text around a slow image from a local server is not held up')
+    p.add_argument('--delay', type=float, default=1, help='seconds the server waits before answering')
+    p.set_defaults(fn=images)
+    p = sub.add_parser('tables', help='table layout: even split against measured columns')
+    p.add_argument('--width', type=int, default=100)
+    p.add_argument('--rows', type=int, default=8, help='TableRows to hold back')
+    p.add_argument('--long', type=int, default=2000, help='rows in the made up long table')
+    p.add_argument('files', nargs='*')
+    p.set_defaults(fn=tables)
+    p = sub.add_parser('exec', help='--exec on a program dumping megabytes, then key echo latency')
+    p.add_argument('--mb', type=float, default=4)
+    p.add_argument('--keys', type=int, default=50)
+    p.set_defaults(fn=exec_)
+    p = sub.add_parser('soak', help='peak memory and time per line of very long code blocks')
+    p.add_argument('--lines', type=int, default=1000)
+    p.add_argument('--spill', type=int, default=2**15, help='CodeBuffer.Spill')
+    p.add_argument('--times', type=int, default=4)
+    p.add_argument('--slack', type=float, default=1, help='MB the peak can go up by for the bigger blocks')
+    p.set_defaults(fn=soak)
+    p = sub.add_parser('capture', help='what Logging costs and --replay coming out the same, and in time')
+    p.add_argument('--delay', type=float, default=0.005, help='seconds between chunks when recording')
+    p.add_argument('--speed', type=float, default=4)
+    p.add_argument('--rounds', type=int, default=3)
+    p.add_argument('files', nargs='*')
+    p.set_defaults(fn=capture)
+    p = sub.add_parser('suite', help='every fixture in process, whole, by line and by recorded chunk')
+    p.add_argument('--rounds', type=int, default=3)
+    p.add_argument('--min-time', type=float, default=0.5, help='seconds to keep repeating each one for')
+    p.add_argument('--out', help='write the results here as json')
+    p.add_argument('files', nargs='*')
+    p.set_defaults(fn=suite)
+    p = sub.add_parser('compare', help='compare two suite results')
+    p.add_argument('old')
+    p.add_argument('new')
+    p.add_argument('--threshold', type=float, default=10, help='percent slower that counts as worse')
+    p.set_defaults(fn=compare)
+    args = parser.parse_args()
+    args.fn(args)